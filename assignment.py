@@ -0,0 +1,112 @@
+'''
+Tile assignment with usage constraints
+
+assign_tiles matches every tile with a picture of the palette like
+LabIndex.closest, but can limit how many times a picture is used and forbid
+a picture to be repeated too close to itself. It is a greedy pass: tiles are
+taken by increasing DeltaE00 to their unconstrained closest picture, so the
+tiles with the best matches get them first, and every tile takes its closest
+picture still allowed. Pictures used max_uses times are removed from the
+nearest color index, so each tile costs about one index query and the whole
+pass is O(T log N) instead of O(T*N).
+'''
+import numpy as np
+import color_diff
+from color_index import LabIndex
+
+class SpacingGrid:
+    '''
+    Positions of the assigned pictures hashed in cells of min_distance pixels
+    '''
+    def __init__(self, min_distance):
+        self.min_distance = float(min_distance)
+        self.cells = {}
+
+    def cell(self, center):
+        return (int(center[0]//self.min_distance), int(center[1]//self.min_distance))
+
+    def allowed(self, pic_idx, center):
+        cell_x, cell_y = self.cell(center)
+        for neighbour in ((cell_x + dx, cell_y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+            for placed_idx, placed_center in self.cells.get(neighbour, ()):
+                if placed_idx == pic_idx and np.hypot(placed_center[0] - center[0], placed_center[1] - center[1]) < self.min_distance:
+                    return False
+        return True
+
+    def add(self, pic_idx, center):
+        self.cells.setdefault(self.cell(center), []).append((pic_idx, center))
+
+def best_allowed(available, lab, spacing, center, k):
+    '''
+    Closest picture still available and allowed by the spacing constraint
+
+    Args:
+        available (color_index.LabIndex) : index without the pictures used max_uses times
+        lab (numpy.ndarray) : Lab color of the tile
+        spacing (SpacingGrid) : positions of the assigned pictures, None if no spacing constraint
+        center (tuple) : center of the tile
+        k (int) : number of DeltaE76 candidates re-ranked with DeltaE00
+
+    Returns:
+        pic_idx (int) : index of the picture, None if no picture is allowed
+    '''
+    count = k
+    while True:
+        count = min(count, available.alive_count[0])
+        if count == 0:
+            return None
+        candidates, _ = available.query(lab, count)
+        if spacing is not None:
+            candidates = np.array([pic_idx for pic_idx in candidates if spacing.allowed(pic_idx, center)], dtype=np.int64)
+        if len(candidates):
+            return int(candidates[np.argmin(color_diff.delta_e_cie2000(lab, available.labs[candidates]))])
+        if count == available.alive_count[0]:
+            return None
+        count *= 4
+
+def assign_tiles(tiles_labs, tiles_boxes, index, max_uses=None, min_distance=None, k=8):
+    '''
+    Match tiles with pictures of the palette under usage constraints
+
+    Args:
+        tiles_labs (array_like) : (T, 3) Lab colors of the tiles
+        tiles_boxes (list) : T tiles (x_left, y_top, x_right, y_bottom) in the model image
+        index (color_index.LabIndex) : nearest color index of the palette
+        max_uses (int) : maximal number of tiles a picture can be used for, unlimited if None
+        min_distance (float) : minimal distance in pixels of the model image between
+            the centers of two tiles using the same picture, no constraint if None
+        k (int) : number of DeltaE76 candidates re-ranked with DeltaE00, see LabIndex.closest
+
+    Returns:
+        (assigned, violations) :
+            assigned (numpy.ndarray) : (T,) palette index of each tile
+            violations (int) : number of tiles which got their closest picture
+                because no picture satisfied the constraints
+    '''
+    tiles_labs = np.asarray(tiles_labs, dtype=np.float64).reshape(-1, 3)
+    closest = np.array([index.closest_index(lab, k) for lab in tiles_labs], dtype=np.int64)
+    assigned = closest.copy()
+    if max_uses is None and min_distance is None:
+        return assigned, 0
+    closest_deltas = color_diff.delta_e_cie2000(tiles_labs, index.labs[closest])
+    # pictures used max_uses times are removed from a private copy of the index
+    available = LabIndex(index.paths, index.labs, index.leaf_size, index.brute_force_ratio)
+    spacing = SpacingGrid(min_distance) if min_distance else None
+    uses = np.zeros(len(index), dtype=np.int64)
+    violations = 0
+    for tile in np.argsort(closest_deltas, kind='mergesort'):
+        box = tiles_boxes[tile]
+        center = ((box[0] + box[2])/2.0, (box[1] + box[3])/2.0)
+        pic_idx = closest[tile]
+        if uses[pic_idx] == max_uses or (spacing is not None and not spacing.allowed(pic_idx, center)):
+            pic_idx = best_allowed(available, tiles_labs[tile], spacing, center, k)
+            if pic_idx is None:
+                pic_idx = closest[tile]
+                violations += 1
+        assigned[tile] = pic_idx
+        uses[pic_idx] += 1
+        if uses[pic_idx] == max_uses:
+            available.remove(pic_idx)
+        if spacing is not None:
+            spacing.add(pic_idx, center)
+    return assigned, violations
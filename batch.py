@@ -0,0 +1,203 @@
+'''
+Batch photo mosaics of many model images against one library
+
+The library is analyzed (through the dataset cache), indexed and its tile
+cache created once, then every job of the manifest runs in a thread sharing
+them. A manifest is a JSON list of jobs:
+    [
+        {"model_path": "dataset/Tram/DSC_0809.JPG", "tile_width": 12, "scale": 10},
+        {"model_path": "models/beach.jpg", "tile_width": 16, "tile_ratio": 1, "scale": 4,
+         "pic_maxsize": [2048, 2048], "name": "beach_16", "max_uses": 20}
+    ]
+Each job writes photo_mosaic.png (photo_mosaic.ppm if "streaming" is set)
+and mosaic_datas.txt in output_dir/name, name defaults to the model file
+name and its index in the manifest. The summary report (batch_report.json)
+gives the status, timings and error of every job.
+
+Usage: python batch.py manifest.json [--workers N] [--output-dir DIR] [--dataset DIR]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from color_index import LabIndex
+from dataset_cache import DatasetCache
+from tile_cache import TileCache
+from match_lut import load_match_lut
+from main import (gen_dataset_parallel, analyze_pic_fast, analyze_model, photo_mosaic_datas,
+                  save_dict, gen_photo_mosaic, gen_photo_mosaic_streaming)
+
+JOB_DEFAULTS = {
+    'tile_width': 12,
+    'tile_ratio': 4/3,
+    'pic_maxsize': (1024, 1024),
+    'scale': 10,
+    'max_uses': None,
+    'min_distance': None,
+    'streaming': False,
+}
+
+def read_manifest(manifest_path):
+    '''
+    Read a job manifest and fill the missing settings with JOB_DEFAULTS
+
+    Args:
+        manifest_path (str) : path of the JSON manifest
+
+    Returns:
+        jobs (list) : list of job dicts, each with a unique name
+    '''
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.loads(manifest_file.read())
+    jobs = []
+    for job_idx, job_settings in enumerate(manifest):
+        if 'model_path' not in job_settings:
+            raise ValueError('job {} of {} has no model_path'.format(job_idx, manifest_path))
+        job = dict(JOB_DEFAULTS)
+        job.update(job_settings)
+        job['pic_maxsize'] = tuple(job['pic_maxsize'])
+        if 'tile_height' not in job:
+            job['tile_height'] = int(job['tile_width']/job['tile_ratio'])
+        if 'name' not in job:
+            job['name'] = '{}_{}'.format(job_idx, os.path.splitext(os.path.basename(job['model_path']))[0])
+        jobs.append(job)
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError('job names of {} are not unique'.format(manifest_path))
+    return jobs
+
+class Library:
+    '''
+    Palette, matching index and tile cache shared by the jobs of a batch
+
+    Args:
+        dataset_path (str) : root directory of the pictures
+        cache_path (str) : path of the dataset cache, see dataset_cache.DatasetCache
+        tile_cache (tile_cache.TileCache) : cache of the resized pictures, an in-memory one if None
+        lut_path (str) : path of the color lookup table, see match_lut.MatchLUT, no table if None
+    '''
+    def __init__(self, dataset_path='dataset', cache_path='dataset_cache.json', tile_cache=None, lut_path='match_lut.npz'):
+        cache = DatasetCache(cache_path)
+        self.pics_dict = gen_dataset_parallel(dataset_path, cache=cache, analyze_function=analyze_pic_fast)
+        if cache.dirty:
+            cache.save()
+        # the jobs match with the index (or the lut), so the palette is never sorted
+        self.index = LabIndex.from_dataset(self.pics_dict)
+        self.tile_cache = tile_cache if tile_cache is not None else TileCache()
+        self.lut_path = lut_path
+        self.lut = load_match_lut(lut_path, self.index) if lut_path is not None else None
+
+    def save_lut(self):
+        if self.lut is not None:
+            self.lut.save(self.lut_path)
+
+def run_job(job, library, output_dir):
+    '''
+    Generate the photo mosaic of one job
+
+    Args:
+        job (dict) : job settings, see read_manifest
+        library (Library) : shared palette, index and tile cache
+        output_dir (str) : directory of the job outputs
+
+    Returns:
+        report (dict) : status, output paths and timings in seconds of the job
+    '''
+    report = {'name': job['name'], 'model_path': job['model_path'], 'status': 'ok', 'timings': {}}
+    start_time = time.perf_counter()
+    stage_time = start_time
+    try:
+        job_dir = os.path.join(output_dir, job['name'])
+        os.makedirs(job_dir, exist_ok=True)
+        tile_width, tile_height, pic_maxsize = job['tile_width'], job['tile_height'], job['pic_maxsize']
+
+        model_datas = analyze_model(job['model_path'], tile_width, tile_height, pic_maxsize)
+        report['timings']['analysis'] = time.perf_counter() - stage_time
+        stage_time = time.perf_counter()
+
+        mosaic_dict = photo_mosaic_datas(job['model_path'], None, tile_width, tile_height, pic_maxsize,
+                                         index=library.index, model_datas=model_datas,
+                                         max_uses=job['max_uses'], min_distance=job['min_distance'], lut=library.lut)
+        report['mosaic_datas'] = os.path.join(job_dir, 'mosaic_datas.txt')
+        save_dict(mosaic_dict, report['mosaic_datas'])
+        report['tiles'] = len(mosaic_dict)
+        report['timings']['matching'] = time.perf_counter() - stage_time
+        stage_time = time.perf_counter()
+
+        if job['streaming']:
+            report['output_path'] = os.path.join(job_dir, 'photo_mosaic.ppm')
+            gen_photo_mosaic_streaming(mosaic_dict, tile_width, tile_height, pic_maxsize, scale=job['scale'],
+                                       tile_cache=library.tile_cache, output_path=report['output_path'])
+        else:
+            report['output_path'] = os.path.join(job_dir, 'photo_mosaic.png')
+            gen_photo_mosaic(mosaic_dict, tile_width, tile_height, pic_maxsize, scale=job['scale'],
+                             tile_cache=library.tile_cache, output_path=report['output_path'])
+        report['timings']['rendering'] = time.perf_counter() - stage_time
+    except Exception as error:
+        report['status'] = 'failed'
+        report['error'] = '{}: {}'.format(type(error).__name__, error)
+        report['traceback'] = traceback.format_exc()
+    report['timings']['total'] = time.perf_counter() - start_time
+    return report
+
+def run_batch(jobs, library, output_dir='batch_output', workers=None, report_path=None):
+    '''
+    Run the jobs concurrently against one library and write the summary report
+
+    A failed job does not stop the others, its error is in the report.
+
+    Args:
+        jobs (list) : job dicts, see read_manifest
+        library (Library) : shared palette, index and tile cache
+        output_dir (str) : directory of the job outputs
+        workers (int) : number of jobs running at the same time, defaults to the number of CPUs
+        report_path (str) : path of the summary report, output_dir/batch_report.json if None
+
+    Returns:
+        summary (dict) : the summary report
+    '''
+    workers = workers or os.cpu_count() or 1
+    report_path = report_path or os.path.join(output_dir, 'batch_report.json')
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(lambda job: run_job(job, library, output_dir), jobs))
+    library.save_lut()
+    summary = {
+        'jobs': len(reports),
+        'succeeded': sum(report['status'] == 'ok' for report in reports),
+        'failed': sum(report['status'] != 'ok' for report in reports),
+        'workers': workers,
+        'library_pics': len(library.pics_dict),
+        'wall_time': time.perf_counter() - start_time,
+        'tile_cache': library.tile_cache.stats(),
+        'match_lut': library.lut.stats() if library.lut is not None else None,
+        'reports': reports,
+    }
+    with open(report_path, 'w') as report_file:
+        report_file.write(json.dumps(summary, indent=2))
+    for report in reports:
+        if report['status'] == 'ok':
+            print('{} : ok in {:.2f}s'.format(report['name'], report['timings']['total']))
+        else:
+            print('{} : {}'.format(report['name'], report['error']))
+    print('{} jobs, {} failed, {:.2f}s, report in {}'.format(summary['jobs'], summary['failed'], summary['wall_time'], report_path))
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the photo mosaics of a job manifest')
+    parser.add_argument('manifest', help='JSON list of jobs')
+    parser.add_argument('--workers', type=int, default=None, help='number of concurrent jobs')
+    parser.add_argument('--output-dir', default='batch_output', help='directory of the job outputs')
+    parser.add_argument('--dataset', default='dataset', help='root directory of the pictures')
+    parser.add_argument('--tile-cache-dir', default='tile_cache', help='directory of the on-disk thumbnails')
+    args = parser.parse_args()
+
+    batch_jobs = read_manifest(args.manifest)
+    batch_library = Library(args.dataset, tile_cache=TileCache(cache_dir=args.tile_cache_dir))
+    batch_summary = run_batch(batch_jobs, batch_library, args.output_dir, args.workers)
+    sys.exit(1 if batch_summary['failed'] else 0)
@@ -0,0 +1,75 @@
+'''
+Benchmark of the adaptive (quadtree) tiling against uniform tiles
+
+Matches and renders a synthetic model with uniform small tiles, uniform
+large tiles and quadtree tiles going from the large size down to the small
+one. Reports the number of tiles, the matching and rendering times and the
+quality of the tiling: mean DeltaE76 between each pixel of the model and the
+average color of its tile (the basic mosaic), lower is closer to the model.
+
+Usage: python benchmarks/bench_adaptive_tiling.py [--size N] [--tile-width W] [--levels L] [--max-variance V]
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import color_diff
+import main
+from color_index import LabIndex
+from tile_cache import TileCache
+from synthetic import make_jpeg_library, make_model
+
+def tiling_error(resized_model, tiles_dict):
+    basic = Image.new('RGB', resized_model.size)
+    draw_basic = ImageDraw.Draw(basic)
+    for (x0, y0, x1, y1), color in tiles_dict.items():
+        draw_basic.rectangle((x0, y0, x1 - 1, y1 - 1), fill=color)
+    model_labs = color_diff.rgb_to_lab(np.asarray(resized_model.convert('RGB'), dtype=np.float64).reshape(-1, 3), True)
+    basic_labs = color_diff.rgb_to_lab(np.asarray(basic, dtype=np.float64).reshape(-1, 3), True)
+    return color_diff.delta_e_cie1976(model_labs, basic_labs).mean()
+
+def bench(args, work_dir):
+    dataset_path = os.path.join(work_dir, 'dataset')
+    model_path = os.path.join(work_dir, 'model.jpg')
+    make_jpeg_library(dataset_path, args.size, (160, 120))
+    make_model(model_path)
+    pics_dict = main.gen_dataset(dataset_path, analyze_function=main.analyze_pic_fast)
+    index = LabIndex.from_dataset(pics_dict)
+    pic_maxsize = (1024, 1024)
+    small = (args.tile_width, int(args.tile_width/(4/3)))
+    large = (small[0]*2**args.levels, small[1]*2**args.levels)
+    runs = [
+        ('uniform {}x{}'.format(*small), small, lambda: main.analyze_model(model_path, small[0], small[1], pic_maxsize)),
+        ('uniform {}x{}'.format(*large), large, lambda: main.analyze_model(model_path, large[0], large[1], pic_maxsize)),
+        ('adaptive {}x{} to {}x{}'.format(*(large + small)), large,
+         lambda: main.analyze_model_adaptive(model_path, large[0], large[1], pic_maxsize, args.levels, args.max_variance)),
+    ]
+    for name, tile_size, analyze in runs:
+        model_datas = analyze()
+        start_time = time.perf_counter()
+        mosaic_dict = main.photo_mosaic_datas(model_path, None, tile_size[0], tile_size[1], pic_maxsize,
+                                              index=index, model_datas=model_datas)
+        match_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        main.gen_photo_mosaic(mosaic_dict, tile_size[0], tile_size[1], pic_maxsize, scale=args.scale,
+                              tile_cache=TileCache(), output_path=os.path.join(work_dir, 'photo_mosaic.png'))
+        render_time = time.perf_counter() - start_time
+        print('{:28} {:6} tiles  matching {:6.2f}s  render {:6.2f}s  tiling DeltaE76 {:5.2f}'.format(
+            name, len(mosaic_dict), match_time, render_time, tiling_error(model_datas[0], model_datas[1])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=500, help='number of pictures of the synthetic library')
+    parser.add_argument('--tile-width', type=int, default=8, help='width of the smallest tiles')
+    parser.add_argument('--levels', type=int, default=2)
+    parser.add_argument('--max-variance', type=float, default=300.0)
+    parser.add_argument('--scale', type=int, default=4)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        bench(args, work_dir)
@@ -0,0 +1,44 @@
+'''
+Benchmark of the usage-constrained tile assignment
+
+A random palette is matched with a grid of tiles whose colors are half random
+and half concentrated around one color (a sky, a wall...), the case where the
+unconstrained match repeats the same pictures the most. Reports the time of
+assign_tiles, the most used picture, the number of distinct pictures and the
+mean DeltaE00 for each constraint.
+
+Usage: python benchmarks/bench_assignment.py [palette_size [columns rows]]
+'''
+import os
+import sys
+import time
+import collections
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import color_diff
+from color_index import LabIndex
+from assignment import assign_tiles
+
+def bench(palette_size, columns, rows, tile_size=(12, 9)):
+    random_state = np.random.RandomState(0)
+    palette_labs = color_diff.rgb_to_lab(random_state.randint(0, 256, (palette_size, 3)), True)
+    index = LabIndex(list(range(palette_size)), palette_labs)
+    tiles_count = columns*rows
+    tiles_labs = np.array([[50.0, 10.0, 10.0]]*tiles_count) + random_state.randn(tiles_count, 3)*2
+    tiles_labs[:tiles_count//2] = color_diff.rgb_to_lab(random_state.randint(0, 256, (tiles_count//2, 3)), True)
+    tiles_boxes = [(x*tile_size[0], y*tile_size[1], (x + 1)*tile_size[0], (y + 1)*tile_size[1])
+                   for y in range(rows) for x in range(columns)]
+    for max_uses, min_distance in [(None, None), (20, None), (None, 5*tile_size[0]), (5, 8*tile_size[0])]:
+        start_time = time.perf_counter()
+        assigned, violations = assign_tiles(tiles_labs, tiles_boxes, index, max_uses, min_distance)
+        assign_time = time.perf_counter() - start_time
+        uses = collections.Counter(assigned.tolist())
+        print('max_uses {!s:>5} min_distance {!s:>5} : {:7.2f}s  most used {:5}  distinct {:6}  mean DeltaE00 {:6.2f}  violations {}'.format(
+            max_uses, min_distance, assign_time, max(uses.values()), len(uses),
+            color_diff.delta_e_cie2000(tiles_labs, palette_labs[assigned]).mean(), violations))
+
+if __name__ == '__main__':
+    palette_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    columns, rows = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (100, 80)
+    bench(palette_size, columns, rows)
@@ -0,0 +1,49 @@
+'''
+Benchmark of color_diff against colormath
+
+For each palette size, compute the Delta E between one color and the whole
+palette, and the sRGB to Lab conversion of the whole palette, once with
+colormath (one call per color) and once with color_diff (one call).
+colormath is timed on at most 10000 colors and extrapolated above.
+
+Usage: python benchmarks/bench_color_diff.py [size ...]
+'''
+import os
+import sys
+import time
+import numpy as np
+from colormath.color_objects import sRGBColor, LabColor
+from colormath.color_conversions import convert_color
+from colormath import color_diff as colormath_diff
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import color_diff
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+def bench(size, colormath_max=10000):
+    random_state = np.random.RandomState(size)
+    rgb = random_state.randint(0, 256, (size, 3)).astype(np.float64)
+    sample = rgb[:min(size, colormath_max)]
+    sample_ratio = size/len(sample)
+
+    lab, vectorized_time = timed(color_diff.rgb_to_lab, rgb, True)
+    ref_lab, colormath_time = timed(lambda: np.array([convert_color(sRGBColor(*color, is_upscaled=True), LabColor).get_value_tuple() for color in sample]))
+    print('{:>7} rgb_to_lab       colormath {:9.3f}s  numpy {:8.4f}s  x{:8.1f}  max error {:.1e}'.format(
+        size, colormath_time*sample_ratio, vectorized_time, colormath_time*sample_ratio/vectorized_time, np.abs(ref_lab - lab[:len(sample)]).max()))
+
+    reference = LabColor(*lab[0])
+    for name in ['delta_e_cie1976', 'delta_e_cie1994', 'delta_e_cie2000']:
+        deltas, vectorized_time = timed(getattr(color_diff, name), lab[0], lab)
+        colormath_function = getattr(colormath_diff, name)
+        ref_deltas, colormath_time = timed(lambda: np.array([colormath_function(reference, LabColor(*color)) for color in lab[:len(sample)]]))
+        print('{:>7} {:16} colormath {:9.3f}s  numpy {:8.4f}s  x{:8.1f}  max error {:.1e}'.format(
+            size, name, colormath_time*sample_ratio, vectorized_time, colormath_time*sample_ratio/vectorized_time, np.abs(ref_deltas - deltas[:len(sample)]).max()))
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    for size in sizes:
+        bench(size)
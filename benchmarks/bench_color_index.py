@@ -0,0 +1,53 @@
+'''
+Benchmark of LabIndex against the bisection of closest_pic
+
+For each palette size, a random palette is sorted with NN_delta, then random
+tile colors are matched with closest_pic and with LabIndex.closest. Reports
+the query latency and the mean DeltaE00 between the tiles and their match,
+next to the best possible mean DeltaE00 (exhaustive search).
+
+Usage: python benchmarks/bench_color_index.py [size ...]
+'''
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import color_diff
+from color_index import LabIndex
+from main import NN_delta, closest_pic
+
+def bench(size, tiles_count=1000):
+    random_state = np.random.RandomState(size)
+    palette_labs = color_diff.rgb_to_lab(random_state.randint(0, 256, (size, 3)), True)
+    tiles_labs = color_diff.rgb_to_lab(random_state.randint(0, 256, (tiles_count, 3)), True)
+    dataset = {'pic{}'.format(idx): ('', 1, 1.0, (0.0, 0.0, 0.0), tuple(lab)) for idx, lab in enumerate(palette_labs)}
+    paths_idx = {path: idx for idx, path in enumerate(dataset)}
+    sorted_pics_list = NN_delta(dataset)
+
+    start_time = time.perf_counter()
+    index = LabIndex.from_dataset(dataset)
+    build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    bisection_idx = [paths_idx[closest_pic(lab, sorted_pics_list)] for lab in tiles_labs]
+    bisection_time = (time.perf_counter() - start_time)/tiles_count
+
+    start_time = time.perf_counter()
+    index_idx = [paths_idx[path] for path in index.closest_batch(tiles_labs)]
+    index_time = (time.perf_counter() - start_time)/tiles_count
+
+    best_deltas = np.array([color_diff.delta_e_cie2000(lab, palette_labs).min() for lab in tiles_labs])
+    bisection_deltas = color_diff.delta_e_cie2000(tiles_labs, palette_labs[bisection_idx])
+    index_deltas = color_diff.delta_e_cie2000(tiles_labs, palette_labs[index_idx])
+    print('{:>7} index build {:.3f}s'.format(size, build_time))
+    print('{:>7} bisection  {:8.1f} us/query  mean DeltaE00 {:6.2f}'.format(size, bisection_time*1e6, bisection_deltas.mean()))
+    print('{:>7} LabIndex   {:8.1f} us/query  mean DeltaE00 {:6.2f}  exact matches {:.1%}'.format(
+        size, index_time*1e6, index_deltas.mean(), np.mean(np.isclose(index_deltas, best_deltas))))
+    print('{:>7} exhaustive                    mean DeltaE00 {:6.2f}'.format(size, best_deltas.mean()))
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000]
+    for size in sizes:
+        bench(size)
@@ -0,0 +1,48 @@
+'''
+Benchmark of analyze_pic_fast against analyze_pic
+
+Times both analyses on a synthetic JPEG library and compares their average
+colors with the average of the full resolution picture (no thumbnail).
+
+Usage: python benchmarks/bench_fast_analysis.py [--count N] [--width W] [--height H]
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import color_diff
+from main import CustomStat, analyze_pic, analyze_pic_fast
+from synthetic import make_jpeg_library
+
+def full_resolution_rgb(pic_path):
+    with Image.open(pic_path) as image:
+        return [int(value) for value in CustomStat(image.convert('RGB'))._getmean2()]
+
+def bench(count, size):
+    with tempfile.TemporaryDirectory() as library_path:
+        pics_paths = make_jpeg_library(library_path, count, size)
+        reference = np.array([full_resolution_rgb(pic_path) for pic_path in pics_paths], dtype=np.float64)
+        reference_lab = color_diff.rgb_to_lab(reference, True)
+        for analyze_function in (analyze_pic, analyze_pic_fast):
+            start_time = time.perf_counter()
+            results = [analyze_function(pic_path) for pic_path in pics_paths]
+            elapsed = time.perf_counter() - start_time
+            rgbs = np.array([pic_datas[3] for pic_datas in results])
+            rgb_error = np.abs(rgbs - reference)
+            deltas = color_diff.delta_e_cie2000(reference_lab, color_diff.rgb_to_lab(rgbs, True))
+            print('{}x{} {:16} {:7.2f} ms/pic  rgb error mean {:.2f} max {:.0f}  DeltaE00 mean {:.2f} max {:.2f}'.format(
+                size[0], size[1], analyze_function.__name__, elapsed/count*1000, rgb_error.mean(), rgb_error.max(), deltas.mean(), deltas.max()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    args = parser.parse_args()
+    bench(args.count, (args.width, args.height))
@@ -0,0 +1,45 @@
+'''
+Overhead of the instrumentation hooks
+
+Times an empty stage() block and a timed() function call, instrumentation
+disabled and enabled, against the same code without hooks.
+
+Usage: python benchmarks/bench_instrumentation.py [calls]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+
+def plain(items):
+    return items
+
+@instrumentation.timed('bench timed', items=len)
+def decorated(items):
+    return items
+
+def with_stage(items):
+    with instrumentation.stage('bench stage', len(items)):
+        return items
+
+def per_call(function, calls):
+    items = [0]
+    start_time = time.perf_counter()
+    for _ in range(calls):
+        function(items)
+    return (time.perf_counter() - start_time)/calls
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    baseline = per_call(plain, calls)
+    print('{:28} {:8.3f} us/call'.format('no hook', baseline*1e6))
+    for enabled in (False, True):
+        if enabled:
+            instrumentation.enable()
+        for name, function in (('timed()', decorated), ('stage()', with_stage)):
+            call_time = per_call(function, calls)
+            print('{:28} {:8.3f} us/call  overhead {:8.3f} us'.format(
+                '{} {}'.format(name, 'enabled' if enabled else 'disabled'), call_time*1e6, (call_time - baseline)*1e6))
+    instrumentation.disable()
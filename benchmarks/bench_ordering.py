@@ -0,0 +1,42 @@
+'''
+Benchmark of the palette ordering engines
+
+For each dataset size, sort a random palette with every engine of
+main.ORDERING_ENGINES and report the time and the mean DeltaE00 between
+consecutive pics of the ordering (lower is a smoother palette).
+nn_delta is O(n²) and is skipped above --nn-delta-max pics.
+
+Usage: python benchmarks/bench_ordering.py [size ...] [--nn-delta-max N]
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import color_diff
+from main import ORDERING_ENGINES
+
+def bench(size, nn_delta_max):
+    random_state = np.random.RandomState(size)
+    palette_labs = color_diff.rgb_to_lab(random_state.randint(0, 256, (size, 3)), True)
+    dataset = {'pic{}'.format(idx): ('', 1, 1.0, (0.0, 0.0, 0.0), tuple(lab)) for idx, lab in enumerate(palette_labs)}
+    for engine, sort_function in sorted(ORDERING_ENGINES.items()):
+        if engine == 'nn_delta' and size > nn_delta_max:
+            print('{:>7} {:9} skipped'.format(size, engine))
+            continue
+        start_time = time.perf_counter()
+        sorted_datas = sort_function(dataset)
+        elapsed = time.perf_counter() - start_time
+        sorted_labs = np.array([pic_datas[-1] for pic, pic_datas in sorted_datas])
+        smoothness = color_diff.delta_e_cie2000(sorted_labs[:-1], sorted_labs[1:]).mean()
+        print('{:>7} {:9} {:9.3f}s  mean consecutive DeltaE00 {:6.2f}'.format(size, engine, elapsed, smoothness))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', type=int, nargs='*', default=[1000, 10000, 100000])
+    parser.add_argument('--nn-delta-max', type=int, default=10000)
+    args = parser.parse_args()
+    for size in args.sizes:
+        bench(size, args.nn_delta_max)
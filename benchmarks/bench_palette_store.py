@@ -0,0 +1,80 @@
+'''
+Benchmark of the palette store against the JSON dataset files
+
+Writes a synthetic dataset of the given size as analyzed_dataset.txt and
+sorted_dataset.txt (save_dict / json, as in the __main__ block of main.py)
+and as a palette store, then loads each one in a fresh process and reports
+load time and peak RSS of that process (Linux only).
+
+Usage: python benchmarks/bench_palette_store.py [size ...] [--dir DIR]
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+from main import save_dict
+from palette_store import save_palette_store
+
+LOADERS = {
+    'interpreter only': 'datas = None',
+    'json analyzed_dataset': 'from main import open_dict; datas = open_dict({analyzed!r})',
+    'json sorted_dataset': 'import json; datas = [tuple(data) for data in json.loads(open({sorted!r}).read())]',
+    'palette store (mmap)': 'from palette_store import PaletteStore; datas = PaletteStore({store!r}); datas.labs.sum(); datas.path(len(datas) - 1)',
+    'palette store sorted list': 'from palette_store import PaletteStore; datas = PaletteStore({store!r}).sorted_pics_list()',
+}
+
+# ru_maxrss can keep the high-water mark of the parent process across exec,
+# the VmHWM line of /proc/self/status does not (Linux only)
+MEASURE = '''
+import sys, time
+sys.path.insert(0, {repo!r})
+start_time = time.perf_counter()
+{loader}
+elapsed = time.perf_counter() - start_time
+with open('/proc/self/status') as status_file:
+    peak_kb = [line.split()[1] for line in status_file if line.startswith('VmHWM')][0]
+print(elapsed, peak_kb)
+'''
+
+def synthetic_dataset(size):
+    random_state = np.random.RandomState(size)
+    rgbs = random_state.randint(0, 256, (size, 3)).astype(np.float64)
+    labs = random_state.rand(size, 3)*[100, 200, 200] - [0, 100, 100]
+    return {'dataset/folder{}/DSC_{:06d}.JPG'.format(idx % 100, idx): ('2017:08:01 12:00:00', 1, 1.5, tuple(rgb), tuple(lab))
+            for idx, (rgb, lab) in enumerate(zip(rgbs.tolist(), labs.tolist()))}
+
+def bench(size, bench_dir):
+    pics_dict = synthetic_dataset(size)
+    paths = {
+        'analyzed': os.path.join(bench_dir, 'analyzed_dataset.txt'),
+        'sorted': os.path.join(bench_dir, 'sorted_dataset.txt'),
+        'store': os.path.join(bench_dir, 'palette_store'),
+    }
+    save_dict(pics_dict, paths['analyzed'])
+    sorted_pics_list = list(pics_dict.items())
+    with open(paths['sorted'], 'w') as dataset_file:
+        dataset_file.write(json.dumps(sorted_pics_list))
+    save_palette_store(paths['store'], pics_dict, sorted_pics_list)
+    for name, loader in LOADERS.items():
+        code = MEASURE.format(repo=REPO_PATH, loader=loader.format(**paths))
+        output = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+        elapsed, peak = float(output[-2]), int(output[-1])
+        print('{:>7} {:25} {:8.3f}s  peak RSS {:7.1f} MB'.format(size, name, elapsed, peak/1024))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', type=int, nargs='*', default=[10000, 200000])
+    parser.add_argument('--dir', default=None, help='directory of the generated files, a temporary one by default')
+    args = parser.parse_args()
+    for size in args.sizes:
+        if args.dir:
+            bench(size, args.dir)
+        else:
+            with tempfile.TemporaryDirectory() as bench_dir:
+                bench(size, bench_dir)
@@ -0,0 +1,194 @@
+'''
+Benchmark of the whole pipeline on a synthetic library
+
+Generates (or reuses) a synthetic JPEG library and a model image, then runs
+the hot paths of main.py one after the other and records for each stage its
+wall time, number of items, throughput and peak RSS:
+    gen_dataset : analysis of every picture
+    NN_delta : original nearest neighbour ordering (skipped above --nn-delta-max pictures)
+    nn_index_order : ordering accelerated by LabIndex
+    model_analysis : decoding, resizing and averaging the tiles of the model
+    closest_pic : matching the tiles by bisection of the sorted palette
+    index_matching : matching the tiles with LabIndex
+    gen_photo_mosaic : rendering the photo mosaic
+
+The results are written as JSON (--output) and can be compared with the
+JSON of a previous run (--compare): stages slower than the baseline by more
+than --threshold are reported and the exit code is 1. Use --repeat to
+reduce the noise of the short stages.
+
+The peak RSS of a stage is measured by resetting the high-water mark of the
+process before the stage (/proc/self/clear_refs, Linux only); elsewhere it is
+the peak of the whole process so far.
+
+Usage: python benchmarks/bench_pipeline.py [--size N] [--library DIR] [--output FILE] [--compare FILE]
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main
+from instrumentation import reset_peak_rss, peak_rss_mb
+from ordering import nn_index_order
+from color_index import LabIndex
+from synthetic import COLOR_DISTRIBUTIONS, make_jpeg_library, make_model
+
+class StageRecorder:
+    '''
+    Args:
+        repeat (int) : number of runs of each stage, the fastest one is recorded
+    '''
+    def __init__(self, repeat=1):
+        self.repeat = repeat
+        self.stages = {}
+        self.per_stage_peak = reset_peak_rss()
+
+    def run(self, stage, items, function, *args, **kwargs):
+        '''
+        Run function(*args, **kwargs) as a stage of items items and record it
+
+        Returns:
+            result : the result of function
+        '''
+        reset_peak_rss()
+        elapsed = None
+        for _ in range(self.repeat):
+            start_time = time.perf_counter()
+            result = function(*args, **kwargs)
+            run_time = time.perf_counter() - start_time
+            elapsed = run_time if elapsed is None else min(elapsed, run_time)
+        self.stages[stage] = {
+            'seconds': elapsed,
+            'items': items,
+            'items_per_second': items/elapsed if elapsed > 0 else None,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        print('{:18} {:9.3f}s {:9} items {:12.1f} items/s  peak RSS {:8.1f} MB'.format(
+            stage, elapsed, items, self.stages[stage]['items_per_second'] or 0, self.stages[stage]['peak_rss_mb']))
+        return result
+
+def prepare_library(library_path, size, pic_size, distribution, seed):
+    '''
+    Generate the synthetic library, or reuse it if it was generated with the same settings
+    '''
+    settings = {'size': size, 'pic_size': list(pic_size), 'distribution': distribution, 'seed': seed}
+    settings_path = os.path.join(library_path, 'library.json')
+    if os.path.exists(settings_path):
+        with open(settings_path, 'r') as settings_file:
+            if json.loads(settings_file.read()) == settings:
+                return
+    start_time = time.perf_counter()
+    make_jpeg_library(os.path.join(library_path, 'dataset'), size, pic_size, seed=seed, distribution=distribution)
+    make_model(os.path.join(library_path, 'model.jpg'), seed=seed)
+    with open(settings_path, 'w') as settings_file:
+        settings_file.write(json.dumps(settings))
+    print('library of {} pictures generated in {:.1f}s'.format(size, time.perf_counter() - start_time))
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench(library_path, args, work_dir):
+    recorder = StageRecorder(args.repeat)
+    dataset_path = os.path.join(library_path, 'dataset')
+    model_path = os.path.join(library_path, 'model.jpg')
+    tile_width = args.tile_width
+    tile_height = int(tile_width/(4/3))
+    pic_maxsize = (args.model_size, args.model_size)
+
+    pics_dict = recorder.run('gen_dataset', args.size, main.gen_dataset, dataset_path)
+    if args.size <= args.nn_delta_max:
+        sorted_pics_list = recorder.run('NN_delta', args.size, main.NN_delta, pics_dict)
+    sorted_pics_list = recorder.run('nn_index_order', args.size, nn_index_order, pics_dict)
+
+    tiles_count = len(main.tiling(model_path, tile_width, tile_height, pic_maxsize))
+    model_datas = recorder.run('model_analysis', tiles_count, main.analyze_model, model_path, tile_width, tile_height, pic_maxsize)
+    tiles_labs = main.rgb_to_lab(list(model_datas[1].values()))
+    recorder.run('closest_pic', tiles_count, lambda: [main.closest_pic(lab, sorted_pics_list) for lab in tiles_labs])
+    index = LabIndex.from_dataset(pics_dict)
+    mosaic_dict = recorder.run('index_matching', tiles_count, main.photo_mosaic_datas, model_path, sorted_pics_list,
+                               tile_width, tile_height, pic_maxsize, index=index, model_datas=model_datas)
+    recorder.run('gen_photo_mosaic', tiles_count, main.gen_photo_mosaic, mosaic_dict, tile_width, tile_height, pic_maxsize,
+                 scale=args.scale, output_path=os.path.join(work_dir, 'photo_mosaic.png'))
+    return {
+        'meta': {
+            'size': args.size,
+            'pic_size': [args.pic_width, args.pic_height],
+            'distribution': args.distribution,
+            'tiles': tiles_count,
+            'scale': args.scale,
+            'repeat': args.repeat,
+            'per_stage_peak_rss': recorder.per_stage_peak,
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'stages': recorder.stages,
+    }
+
+def compare(results, baseline, threshold):
+    '''
+    Print the time and peak RSS ratios of each stage against a baseline run
+
+    Returns:
+        regressions (list) : stages slower than the baseline by more than threshold
+    '''
+    regressions = []
+    for stage, stage_results in results['stages'].items():
+        if stage not in baseline['stages']:
+            print('{:18} not in the baseline'.format(stage))
+            continue
+        baseline_results = baseline['stages'][stage]
+        time_ratio = stage_results['seconds']/max(baseline_results['seconds'], 1e-9)
+        rss_ratio = stage_results['peak_rss_mb']/max(baseline_results['peak_rss_mb'], 1e-9)
+        regressed = time_ratio > 1 + threshold
+        if regressed:
+            regressions.append(stage)
+        print('{:18} time x{:6.2f}  peak RSS x{:5.2f}{}'.format(stage, time_ratio, rss_ratio, '  REGRESSION' if regressed else ''))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on a synthetic library')
+    parser.add_argument('--size', type=int, default=1000, help='number of pictures, e.g. 1000, 10000 or 100000')
+    parser.add_argument('--pic-width', type=int, default=320)
+    parser.add_argument('--pic-height', type=int, default=240)
+    parser.add_argument('--distribution', default='uniform', choices=COLOR_DISTRIBUTIONS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--library', default=None, help='directory of the synthetic library, kept between runs, a temporary one by default')
+    parser.add_argument('--tile-width', type=int, default=12)
+    parser.add_argument('--model-size', type=int, default=1024, help='pic_maxsize of the model')
+    parser.add_argument('--scale', type=int, default=2)
+    parser.add_argument('--nn-delta-max', type=int, default=20000, help='skip NN_delta above this number of pictures')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each stage, the fastest one is recorded')
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    parser.add_argument('--compare', default=None, help='JSON file of a baseline run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        library_path = args.library or os.path.join(work_dir, 'library')
+        prepare_library(library_path, args.size, (args.pic_width, args.pic_height), args.distribution, args.seed)
+        results = bench(library_path, args, work_dir)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.loads(baseline_file.read())
+        if baseline['meta']['size'] != results['meta']['size']:
+            print('warning: the baseline has {} pictures, this run {}'.format(baseline['meta']['size'], results['meta']['size']))
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
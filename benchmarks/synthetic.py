@@ -0,0 +1,116 @@
+'''
+Synthetic JPEG library for the benchmarks
+
+The pictures are random blocks of color with the exif tags read by
+main.extract_exif (date, orientation, pixel dimensions). The base colors of
+the pictures follow one of COLOR_DISTRIBUTIONS:
+    uniform : uniform in the RGB cube
+    clustered : a few dominant colors with some spread, like a library of trips
+    skewed : mostly dark and desaturated, like indoor and night photos
+    gray : shades of gray only, the worst case for the ordering and matching
+'''
+import os
+import numpy as np
+from PIL import Image
+
+def exif_bytes(datepic, orientation, size):
+    exif = Image.Exif()
+    exif[274] = orientation
+    exif_ifd = exif.get_ifd(0x8769)
+    exif_ifd[36867] = datepic
+    exif_ifd[40962] = size[0]
+    exif_ifd[40963] = size[1]
+    return exif.tobytes()
+
+COLOR_DISTRIBUTIONS = ('uniform', 'clustered', 'skewed', 'gray')
+# mostly landscape pictures, some taken rotated
+ORIENTATIONS = (1, 1, 1, 1, 6, 1, 1, 8, 1, 3)
+
+def base_colors(random_state, count, distribution='uniform', clusters=12):
+    '''
+    Base RGB colors of the synthetic pictures
+
+    Args:
+        random_state (numpy.random.RandomState) : source of randomness
+        count (int) : number of colors
+        distribution (str) : one of COLOR_DISTRIBUTIONS
+        clusters (int) : number of dominant colors of the clustered distribution
+
+    Returns:
+        colors (numpy.ndarray) : (count, 3) int64 colors between 0 and 255
+    '''
+    if distribution == 'uniform':
+        colors = random_state.randint(0, 256, (count, 3))
+    elif distribution == 'clustered':
+        centers = random_state.randint(0, 256, (clusters, 3))
+        colors = centers[random_state.randint(0, clusters, count)] + random_state.normal(0, 18, (count, 3))
+    elif distribution == 'skewed':
+        gray = 255*random_state.beta(1.5, 5, (count, 1))
+        colors = gray + random_state.normal(0, 12, (count, 3))
+    elif distribution == 'gray':
+        colors = np.repeat(random_state.randint(0, 256, (count, 1)), 3, axis=1)
+    else:
+        raise ValueError('unknown color distribution {}, use one of {}'.format(distribution, COLOR_DISTRIBUTIONS))
+    return np.clip(np.round(colors), 0, 255).astype(np.int64)
+
+def make_picture(random_state, size, base_color, blocks=8):
+    pixels = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    pixels[:] = base_color
+    for _ in range(blocks):
+        x, y = random_state.randint(0, size[0]), random_state.randint(0, size[1])
+        width, height = random_state.randint(1, size[0]//2 + 2), random_state.randint(1, size[1]//2 + 2)
+        pixels[y:y+height, x:x+width] = np.clip(base_color + random_state.randint(-60, 61, 3), 0, 255)
+    pixels = np.clip(pixels + random_state.randint(-8, 9, pixels.shape), 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+def make_jpeg_library(root_path, count, size=(640, 480), seed=0, folders=10, quality=85, distribution='uniform'):
+    '''
+    Write a synthetic JPEG library
+
+    Args:
+        root_path (str) : folder of the library, pictures are spread in subfolders
+        count (int) : number of pictures
+        size (tuple) : (width, height) of the pictures
+        seed (int) : seed of the random colors
+        folders (int) : number of subfolders
+        quality (int) : JPEG quality
+        distribution (str) : distribution of the base colors, one of COLOR_DISTRIBUTIONS
+
+    Returns:
+        pics_paths (list) : paths of the written pictures
+    '''
+    random_state = np.random.RandomState(seed)
+    colors = base_colors(random_state, count, distribution)
+    pics_paths = []
+    for idx in range(count):
+        folder = os.path.join(root_path, 'folder{:03d}'.format(idx % folders))
+        os.makedirs(folder, exist_ok=True)
+        pic_path = os.path.join(folder, 'DSC_{:06d}.JPG'.format(idx))
+        base_color = colors[idx]
+        picture = make_picture(random_state, size, base_color)
+        datepic = '{}:{:02d}:{:02d} {:02d}:00:00'.format(2010 + idx % 8, idx % 12 + 1, idx % 28 + 1, idx % 24)
+        orientation = ORIENTATIONS[idx % len(ORIENTATIONS)]
+        picture.save(pic_path, quality=quality, exif=exif_bytes(datepic, orientation, size))
+        pics_paths.append(pic_path)
+    return pics_paths
+
+def make_model(model_path, size=(1024, 768), seed=0):
+    '''
+    Write a synthetic model image: smooth gradients with a few sharp shapes
+
+    Args:
+        model_path (str) : path of the model image
+        size (tuple) : (width, height) of the model image
+        seed (int) : seed of the random shapes
+    '''
+    random_state = np.random.RandomState(seed)
+    x = np.linspace(0, 1, size[0])[None, :]
+    y = np.linspace(0, 1, size[1])[:, None]
+    pixels = np.empty((size[1], size[0], 3))
+    pixels[..., 0] = 255*x*np.ones_like(y)
+    pixels[..., 1] = 255*y*np.ones_like(x)
+    pixels[..., 2] = 255*(1 - x*y)
+    for _ in range(6):
+        x0, y0 = random_state.randint(0, size[0]), random_state.randint(0, size[1])
+        pixels[y0:y0 + size[1]//5, x0:x0 + size[0]//5] = random_state.randint(0, 256, 3)
+    Image.fromarray(pixels.astype(np.uint8)).save(model_path, quality=90)
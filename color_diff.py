@@ -0,0 +1,125 @@
+'''
+Vectorized color conversion and color difference formulas
+
+Every function works on NumPy arrays whose last axis holds the three color
+coordinates and broadcasts like NumPy does, so the same call compares
+    one color (3,) against a palette (N, 3),
+    two palettes (N, 3) and (N, 3) pair by pair,
+    or all the pairs of two palettes with pairwise().
+The formulas follow colormath (color_conversions, color_diff_matrix) so the
+results match colormath's convert_color and delta_e_* functions.
+'''
+import numpy as np
+
+# sRGB working space (D65) as defined in colormath.color_objects.sRGBColor
+RGB_TO_XYZ = np.array([[0.412424, 0.357579, 0.180464],
+                       [0.212656, 0.715158, 0.0721856],
+                       [0.0193324, 0.119193, 0.950444]])
+D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+CIE_E = 216.0/24389.0
+
+def rgb_to_lab(rgb, is_upscaled=False):
+    '''
+    Convert sRGB colors to Lab (D65), like convert_color(sRGBColor(r, g, b), LabColor)
+
+    Args:
+        rgb (array_like) : (..., 3) sRGB colors
+        is_upscaled (bool) : same meaning as in sRGBColor, True if rgb values are 0 - 255
+
+    Returns:
+        lab (numpy.ndarray) : (..., 3) Lab colors as floats
+    '''
+    rgb = np.asarray(rgb, dtype=np.float64)
+    if is_upscaled:
+        rgb = rgb/255.0
+    linear = np.where(rgb <= 0.04045, rgb/12.92, np.power((np.maximum(rgb, 0.04045) + 0.055)/1.055, 2.4))
+    xyz = np.maximum(np.dot(linear, RGB_TO_XYZ.T), 0.0)/D65_WHITE
+    xyz = np.where(xyz > CIE_E, np.cbrt(xyz), 7.787*xyz + 16.0/116.0)
+    lab = np.empty(xyz.shape)
+    lab[..., 0] = 116.0*xyz[..., 1] - 16.0
+    lab[..., 1] = 500.0*(xyz[..., 0] - xyz[..., 1])
+    lab[..., 2] = 200.0*(xyz[..., 1] - xyz[..., 2])
+    return lab
+
+def pairwise(delta_e, lab1, lab2, **kwargs):
+    '''
+    Compute a color difference between all the pairs of two palettes
+
+    Args:
+        delta_e (function) : one of the delta_e_* functions of this module
+        lab1 (array_like) : (N, 3) Lab colors
+        lab2 (array_like) : (M, 3) Lab colors
+
+    Returns:
+        deltas (numpy.ndarray) : (N, M) color differences
+    '''
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    return delta_e(lab1[:, np.newaxis, :], lab2[np.newaxis, :, :], **kwargs)
+
+def delta_e_cie1976(lab1, lab2):
+    '''
+    Delta E (CIE1976), euclidean distance in Lab
+    '''
+    diff = np.asarray(lab1, dtype=np.float64) - np.asarray(lab2, dtype=np.float64)
+    return np.sqrt(np.sum(diff*diff, axis=-1))
+
+def delta_e_cie1994(lab1, lab2, K_L=1, K_C=1, K_H=1, K_1=0.045, K_2=0.015):
+    '''
+    Delta E (CIE1994), lab1 is the reference color
+    '''
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    C_1 = np.sqrt(lab1[..., 1]**2 + lab1[..., 2]**2)
+    C_2 = np.sqrt(lab2[..., 1]**2 + lab2[..., 2]**2)
+    delta_L = lab1[..., 0] - lab2[..., 0]
+    delta_C = C_1 - C_2
+    delta_H_sq = (lab1[..., 1] - lab2[..., 1])**2 + (lab1[..., 2] - lab2[..., 2])**2 - delta_C**2
+    delta_H = np.sqrt(np.clip(delta_H_sq, 0, None))
+    S_C = 1 + K_1*C_1
+    S_H = 1 + K_2*C_1
+    return np.sqrt((delta_L/K_L)**2 + (delta_C/(K_C*S_C))**2 + (delta_H/(K_H*S_H))**2)
+
+def delta_e_cie2000(lab1, lab2, Kl=1, Kc=1, Kh=1):
+    '''
+    Delta E (CIE2000)
+    '''
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+    avg_Lp = (L1 + L2)/2.0
+    C1 = np.sqrt(a1**2 + b1**2)
+    C2 = np.sqrt(a2**2 + b2**2)
+    avg_C1_C2 = (C1 + C2)/2.0
+    G = 0.5*(1 - np.sqrt(avg_C1_C2**7.0/(avg_C1_C2**7.0 + 25.0**7.0)))
+    a1p = (1.0 + G)*a1
+    a2p = (1.0 + G)*a2
+    C1p = np.sqrt(a1p**2 + b1**2)
+    C2p = np.sqrt(a2p**2 + b2**2)
+    avg_C1p_C2p = (C1p + C2p)/2.0
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p = h1p + (h1p < 0)*360
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p = h2p + (h2p < 0)*360
+    avg_Hp = ((np.fabs(h1p - h2p) > 180)*360 + h1p + h2p)/2.0
+    T = (1 - 0.17*np.cos(np.radians(avg_Hp - 30))
+         + 0.24*np.cos(np.radians(2*avg_Hp))
+         + 0.32*np.cos(np.radians(3*avg_Hp + 6))
+         - 0.2*np.cos(np.radians(4*avg_Hp - 63)))
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = diff_h2p_h1p + (np.fabs(diff_h2p_h1p) > 180)*360
+    delta_hp = delta_hp - (h2p > h1p)*720
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2*np.sqrt(C2p*C1p)*np.sin(np.radians(delta_hp)/2.0)
+    S_L = 1 + (0.015*(avg_Lp - 50)**2)/np.sqrt(20 + (avg_Lp - 50)**2.0)
+    S_C = 1 + 0.045*avg_C1p_C2p
+    S_H = 1 + 0.015*avg_C1p_C2p*T
+    delta_ro = 30*np.exp(-(((avg_Hp - 275)/25)**2.0))
+    R_C = np.sqrt(avg_C1p_C2p**7.0/(avg_C1p_C2p**7.0 + 25.0**7.0))
+    R_T = -2*R_C*np.sin(2*np.radians(delta_ro))
+    return np.sqrt((delta_Lp/(S_L*Kl))**2
+                   + (delta_Cp/(S_C*Kc))**2
+                   + (delta_Hp/(S_H*Kh))**2
+                   + R_T*(delta_Cp/(S_C*Kc))*(delta_Hp/(S_H*Kh)))
@@ -0,0 +1,230 @@
+'''
+Nearest color index over the Lab values of a palette
+
+LabIndex is a kd-tree on the Lab coordinates of the palette. Delta E 1976 is
+the euclidean distance in Lab, so the tree gives the exact k nearest colors
+for DeltaE76. closest() then re-ranks those k candidates with DeltaE00.
+Colors can be removed from the index (see remove) so that it can drive a
+nearest neighbour tour of the palette.
+'''
+import heapq
+import numpy as np
+import color_diff
+
+class LabIndex:
+    '''
+    Args:
+        paths (list) : pic_path (str) of every color of the palette
+        labs (array_like) : (N, 3) Lab colors of the palette, in the same order as paths
+        leaf_size (int) : maximal number of colors in a leaf of the tree
+        brute_force_ratio (int) : queries of k neighbours scan all the colors instead of
+            the tree when k*brute_force_ratio is at least the number of colors left
+    '''
+    def __init__(self, paths, labs, leaf_size=32, brute_force_ratio=64):
+        self.paths = list(paths)
+        self.labs = np.asarray(labs, dtype=np.float64).reshape(-1, 3)
+        if len(self.paths) != len(self.labs):
+            raise ValueError('paths and labs must have the same length')
+        if len(self.paths) == 0:
+            raise ValueError('cannot index an empty palette')
+        self.leaf_size = leaf_size
+        self.brute_force_ratio = brute_force_ratio
+        self._build()
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        '''
+        Build the index from a pics_dict (see main.gen_dataset) or a sorted_pics_list (see main.NN_delta)
+        '''
+        items = dataset.items() if isinstance(dataset, dict) else dataset
+        paths = []
+        labs = []
+        for pic, pic_datas in items:
+            paths.append(pic)
+            labs.append(pic_datas[-1])
+        return cls(paths, labs, **kwargs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _build(self):
+        # nodes are stored in flat lists, children of a leaf are -1 and
+        # the colors of a node are self.order[start:end]
+        order = np.arange(len(self.labs))
+        self.node_start = []
+        self.node_end = []
+        self.node_left = []
+        self.node_right = []
+        node_min = []
+        node_max = []
+        self.node_parent = []
+        stack = [(0, len(order), None, None)]
+        while stack:
+            start, end, parent, is_left = stack.pop()
+            node = len(self.node_start)
+            if parent is not None:
+                if is_left:
+                    self.node_left[parent] = node
+                else:
+                    self.node_right[parent] = node
+            node_labs = self.labs[order[start:end]]
+            low = node_labs.min(axis=0)
+            high = node_labs.max(axis=0)
+            self.node_start.append(start)
+            self.node_end.append(end)
+            self.node_left.append(-1)
+            self.node_right.append(-1)
+            self.node_parent.append(-1 if parent is None else parent)
+            node_min.append(tuple(low.tolist()))
+            node_max.append(tuple(high.tolist()))
+            if end - start <= self.leaf_size:
+                continue
+            split_dim = int(np.argmax(high - low))
+            if high[split_dim] == low[split_dim]:
+                continue
+            middle = (end - start)//2
+            partition = np.argpartition(node_labs[:, split_dim], middle)
+            order[start:end] = order[start:end][partition]
+            stack.append((start + middle, end, node, False))
+            stack.append((start, start + middle, node, True))
+        self.order = order
+        self.ordered_labs = self.labs[order]
+        self.node_boxes = list(zip(node_min, node_max))
+        self.positions = np.empty(len(order), dtype=np.int64)
+        self.positions[order] = np.arange(len(order))
+        self.position_leaf = np.empty(len(order), dtype=np.int64)
+        for node, left in enumerate(self.node_left):
+            if left == -1:
+                self.position_leaf[self.node_start[node]:self.node_end[node]] = node
+        self.removed = np.zeros(len(order), dtype=bool)
+        self.alive_count = [end - start for start, end in zip(self.node_start, self.node_end)]
+
+    def remove(self, index):
+        '''
+        Remove a color from the results of the next queries
+
+        Args:
+            index (int) : index of the color in the palette
+        '''
+        position = self.positions[index]
+        if self.removed[position]:
+            return
+        self.removed[position] = True
+        node = self.position_leaf[position]
+        while node != -1:
+            self.alive_count[node] -= 1
+            node = self.node_parent[node]
+
+    def _box_distance2(self, node, lab):
+        # plain floats, faster than numpy on 3 coordinates
+        distance2 = 0.0
+        for coord, low, high in zip(lab, self.node_boxes[node][0], self.node_boxes[node][1]):
+            if coord < low:
+                distance2 += (low - coord)*(low - coord)
+            elif coord > high:
+                distance2 += (coord - high)*(coord - high)
+        return distance2
+
+    def _query_all(self, lab, k):
+        positions = np.flatnonzero(~self.removed)
+        diff = self.ordered_labs[positions] - lab
+        d2 = np.einsum('ij,ij->i', diff, diff)
+        if len(d2) > k:
+            kept = np.argpartition(d2, k - 1)[:k]
+            positions = positions[kept]
+            d2 = d2[kept]
+        return positions, d2
+
+    def _query_tree(self, lab, k):
+        lab_coords = tuple(lab.tolist())
+        best_positions = np.empty(0, dtype=np.int64)
+        best_d2 = np.empty(0)
+        worst_d2 = np.inf
+        heap = [(0.0, 0)]
+        while heap:
+            box_d2, node = heapq.heappop(heap)
+            if box_d2 > worst_d2:
+                break
+            left = self.node_left[node]
+            if left != -1:
+                right = self.node_right[node]
+                for child in (left, right):
+                    if self.alive_count[child] == 0:
+                        continue
+                    child_d2 = self._box_distance2(child, lab_coords)
+                    if child_d2 <= worst_d2:
+                        heapq.heappush(heap, (child_d2, child))
+                continue
+            start = self.node_start[node]
+            end = self.node_end[node]
+            leaf_positions = np.arange(start, end)
+            if self.alive_count[node] < end - start:
+                leaf_positions = leaf_positions[~self.removed[start:end]]
+            diff = self.ordered_labs[leaf_positions] - lab
+            positions = np.concatenate([best_positions, leaf_positions])
+            d2 = np.concatenate([best_d2, np.einsum('ij,ij->i', diff, diff)])
+            if len(d2) > k:
+                kept = np.argpartition(d2, k - 1)[:k]
+                positions = positions[kept]
+                d2 = d2[kept]
+            best_positions = positions
+            best_d2 = d2
+            if len(best_d2) == k:
+                worst_d2 = best_d2.max()
+        return best_positions, best_d2
+
+    def query(self, lab, k=1):
+        '''
+        Exact k nearest colors of the palette for DeltaE76
+
+        Args:
+            lab (array_like) : (3,) Lab color
+            k (int) : number of neighbours
+
+        Returns:
+            (indices, deltas) :
+                indices (numpy.ndarray) : (k,) indices in the palette, nearest first
+                deltas (numpy.ndarray) : (k,) DeltaE76 to these colors
+            fewer than k if less than k colors are left in the index
+        '''
+        lab = np.asarray(lab, dtype=np.float64)
+        k = min(k, self.alive_count[0])
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        if k*self.brute_force_ratio >= self.alive_count[0]:
+            best_positions, best_d2 = self._query_all(lab, k)
+        else:
+            best_positions, best_d2 = self._query_tree(lab, k)
+        ranking = np.lexsort((best_positions, best_d2))
+        return self.order[best_positions[ranking]], np.sqrt(best_d2[ranking])
+
+    def query_batch(self, labs, k=1):
+        '''
+        Same as query for (M, 3) Lab colors, returns (M, k) indices and deltas
+        '''
+        labs = np.asarray(labs, dtype=np.float64).reshape(-1, 3)
+        k = min(k, self.alive_count[0])
+        indices = np.empty((len(labs), k), dtype=np.int64)
+        deltas = np.empty((len(labs), k))
+        for row, lab in enumerate(labs):
+            indices[row], deltas[row] = self.query(lab, k)
+        return indices, deltas
+
+    def closest_index(self, lab, k=8):
+        '''
+        Index of the palette color with the smallest DeltaE00 among the k nearest for DeltaE76
+        '''
+        indices, _ = self.query(lab, k)
+        return int(indices[np.argmin(color_diff.delta_e_cie2000(lab, self.labs[indices]))])
+
+    def closest(self, lab, k=8):
+        '''
+        Get the path of the pic with the closest color, see closest_index
+        '''
+        return self.paths[self.closest_index(lab, k)]
+
+    def closest_batch(self, labs, k=8):
+        '''
+        Same as closest for (M, 3) Lab colors, returns a list of M paths
+        '''
+        return [self.closest(lab, k) for lab in np.asarray(labs, dtype=np.float64).reshape(-1, 3)]
@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+
+def file_hash(file_path, chunk_size=1 << 20):
+    '''
+    Compute the content hash of a file
+
+    Args:
+        file_path (str) : path of the file
+        chunk_size (int) : number of bytes read at once
+
+    Returns:
+        hexdigest (str) : sha1 of the file content
+    '''
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def as_tuples(pic_datas):
+    if pic_datas is None:
+        return None
+    return tuple(tuple(data) if type(data) is list else data for data in pic_datas)
+
+class DatasetCache:
+    '''
+    Persistent per-file analysis cache
+
+    Entries are keyed by path and are valid as long as the file's mtime and size
+    are unchanged. With use_hash, a file whose mtime or size changed but whose
+    content hash is the same is still a hit (e.g. files touched by a sync tool).
+
+    checkpoint() appends the new entries to a journal next to the cache (one
+    json line per entry), so periodic checkpoints cost the new entries only.
+    The journal is replayed when the cache is opened and merged into the cache
+    file by save().
+
+    Args:
+        cache_path (str) : path of the json file holding the cache
+        use_hash (bool) : also store and compare a content hash of each file
+    '''
+    def __init__(self, cache_path, use_hash=False):
+        self.cache_path = cache_path
+        self.use_hash = use_hash
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.removed = 0
+        self.dirty = False
+        self.journal_path = cache_path + '.journal'
+        self.unjournaled = []
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as cache_file:
+                self.entries = json.loads(cache_file.read())
+        if os.path.exists(self.journal_path):
+            self.replay_journal()
+
+    def replay_journal(self):
+        complete_size = 0
+        with open(self.journal_path, 'rb') as journal_file:
+            for line in journal_file:
+                if not line.endswith(b'\n'):
+                    # last line cut by an interrupted checkpoint
+                    break
+                complete_size += len(line)
+                try:
+                    pic_path, entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                self.entries[pic_path] = entry
+                self.dirty = True
+        # the next checkpoints are appended after the last complete line
+        if complete_size < os.path.getsize(self.journal_path):
+            with open(self.journal_path, 'r+b') as journal_file:
+                journal_file.truncate(complete_size)
+
+    def get(self, pic_path, analyzer='analyze_pic'):
+        '''
+        Get the cached analysis of a picture
+
+        Args:
+            pic_path (str) : path of the picture
+            analyzer (str) : name of the function which analyzed the picture
+
+        Returns:
+            (found, pic_datas) :
+                found (bool) : True if the cached analysis is still valid
+                pic_datas (tuple) : same tuple as main.analyze_pic, None if not found
+        '''
+        entry = self.entries.get(pic_path)
+        if entry is not None and entry.get('analyzer', 'analyze_pic') == analyzer:
+            try:
+                stat = os.stat(pic_path)
+            except OSError:
+                # deleted since the scan, analyze_function skips it
+                self.misses += 1
+                return False, None
+            if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                self.hits += 1
+                return True, as_tuples(entry['datas'])
+            if self.use_hash and entry.get('hash') == file_hash(pic_path):
+                entry['mtime'] = stat.st_mtime
+                entry['size'] = stat.st_size
+                self.unjournaled.append(pic_path)
+                self.dirty = True
+                self.hits += 1
+                return True, as_tuples(entry['datas'])
+        self.misses += 1
+        return False, None
+
+    def put(self, pic_path, pic_datas, analyzer='analyze_pic'):
+        try:
+            stat = os.stat(pic_path)
+        except OSError:
+            # deleted since the scan: nothing to cache, a previous entry is stale
+            if self.entries.pop(pic_path, None) is not None:
+                self.removed += 1
+                self.dirty = True
+            return
+        entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'datas': pic_datas, 'analyzer': analyzer}
+        if self.use_hash:
+            entry['hash'] = file_hash(pic_path)
+        self.entries[pic_path] = entry
+        self.unjournaled.append(pic_path)
+        self.dirty = True
+
+    def prune(self, pics_paths):
+        '''
+        Drop the entries of pictures which are not in the dataset anymore
+
+        Args:
+            pics_paths (iterable) : paths of all the pictures currently in the dataset
+        '''
+        kept_paths = set(pics_paths)
+        for pic_path in list(self.entries.keys()):
+            if pic_path not in kept_paths:
+                del(self.entries[pic_path])
+                self.removed += 1
+                self.dirty = True
+
+    def changed(self):
+        return self.misses > 0 or self.removed > 0
+
+    def outdated(self, file_path):
+        '''
+        Check if a file derived from the dataset has to be generated again
+
+        Args:
+            file_path (str) : path of the file, e.g. analyzed_dataset.txt
+
+        Returns:
+            outdated (bool) : True if the file is missing, the dataset changed during this run,
+                or the cache was saved after the file (e.g. when the journal of an interrupted run was merged)
+        '''
+        if self.changed() or not os.path.exists(file_path):
+            return True
+        return os.path.exists(self.cache_path) and os.path.getmtime(self.cache_path) > os.path.getmtime(file_path)
+
+    def checkpoint(self):
+        '''
+        Append the entries added since the last checkpoint or save to the journal
+        '''
+        if not self.unjournaled:
+            return
+        with open(self.journal_path, 'a') as journal_file:
+            journal_file.write(''.join(json.dumps([pic_path, self.entries[pic_path]]) + '\n'
+                                       for pic_path in self.unjournaled if pic_path in self.entries))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        print('{} entries added to {}'.format(len(self.unjournaled), self.journal_path))
+        self.unjournaled = []
+
+    def save(self):
+        '''
+        Write the whole cache and drop the journal
+        '''
+        # written aside and renamed, so an interrupted save keeps the previous cache and journal
+        temp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            cache_file.write(json.dumps(self.entries))
+        os.replace(temp_path, self.cache_path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.unjournaled = []
+        self.dirty = False
+        print(self.cache_path, 'saved')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'removed': self.removed, 'entries': len(self.entries)}
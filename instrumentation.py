@@ -0,0 +1,375 @@
+'''
+Per-stage instrumentation of the pipeline
+
+The pipeline marks its stages with stage() (a with block) or timed() (a
+decorator): dataset scan, exif read, color averaging, dataset analysis,
+ordering, tile analysis, matching and render. When the instrumentation is
+enabled, every stage records its calls, wall time, items (pictures, tiles)
+and its peak RSS, and the caches report their statistics with record_stats. Results are exported with save_json, or with
+save_trace as a Chrome trace (chrome://tracing, Perfetto).
+
+The instrumentation is disabled by default: stage() then returns a shared
+no-op object and timed() a single test, so the hooks cost well under a
+microsecond per call (see benchmarks/bench_instrumentation.py).
+
+The peak RSS of a stage is measured by resetting the high-water mark of the
+process when a stage starts (/proc/self/clear_refs, Linux only) and reading
+it (VmHWM) whenever a stage starts or ends, each reading counting for every
+stage open at that time. Elsewhere it is the peak of the whole process so far.
+
+Per-picture stages (dataset scan, exif read, color averaging) would fill
+the trace on large libraries, so the trace keeps at most
+MAX_TRACE_EVENTS_PER_STAGE events of each stage.
+
+Stages run in worker processes (gen_dataset_parallel, gen_photo_mosaic_parallel
+with processes) are only seen as the enclosing stage of the parent process.
+
+An optional sampling profiler (start_sampler / stop_sampler) samples the
+Python stacks of all threads and writes them in the collapsed format of
+flamegraph.pl and speedscope (save_samples).
+'''
+import os
+import sys
+import json
+import time
+import threading
+import resource
+from functools import wraps
+from collections import OrderedDict
+
+_enabled = False
+# the trace keeps at most this many events of each stage, the stage totals are always complete
+MAX_TRACE_EVENTS_PER_STAGE = 20000
+
+class ProcFiles:
+    '''
+    /proc/self/status and /proc/self/clear_refs kept open, opened again in a forked process
+    '''
+    def __init__(self):
+        self.pid = None
+
+    def open(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.status = self.clear_refs = None
+        try:
+            self.status = os.open('/proc/self/status', os.O_RDONLY)
+            self.clear_refs = os.open('/proc/self/clear_refs', os.O_WRONLY)
+        except OSError:
+            pass
+
+PROC_FILES = ProcFiles()
+
+def reset_peak_rss():
+    '''
+    Reset the peak RSS of the process, False if the platform can't
+    '''
+    PROC_FILES.open()
+    if PROC_FILES.clear_refs is None:
+        return False
+    try:
+        os.write(PROC_FILES.clear_refs, b'5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    '''
+    Peak RSS of the process since the last reset_peak_rss, or since its start
+    '''
+    PROC_FILES.open()
+    if PROC_FILES.status is not None:
+        status = os.pread(PROC_FILES.status, 4096, 0)
+        start = status.find(b'VmHWM:')
+        if start >= 0:
+            return int(status[start + 6:status.index(b'kB', start)])/1024
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/(1024*1024) if sys.platform == 'darwin' else peak/1024
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.stats = OrderedDict()
+        self.events = []
+        self.stage_events = {}
+        self.dropped_events = {}
+        self.open_stages = set()
+        self.process_peak = 0.0
+
+    def active(self):
+        if not hasattr(self.local, 'active'):
+            self.local.active = set()
+        return self.local.active
+
+    def read_peak(self):
+        # the high-water mark since the last reset counts for every open stage, called with the lock
+        peak = peak_rss_mb()
+        self.process_peak = max(self.process_peak, peak)
+        for open_stage in self.open_stages:
+            open_stage.peak = max(open_stage.peak, peak)
+
+    def begin(self, stage):
+        with self.lock:
+            self.read_peak()
+            reset_peak_rss()
+            stage.peak = 0.0
+            self.open_stages.add(stage)
+
+    def end(self, stage):
+        with self.lock:
+            self.read_peak()
+            self.open_stages.discard(stage)
+
+    def record(self, name, start_time, end_time, items, peak):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'items': 0, 'peak_rss_mb': 0.0}
+            stage['calls'] += 1
+            stage['seconds'] += end_time - start_time
+            stage['items'] += items or 0
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak)
+            if self.stage_events.get(name, 0) < MAX_TRACE_EVENTS_PER_STAGE:
+                self.stage_events[name] = self.stage_events.get(name, 0) + 1
+                self.events.append((name, start_time, end_time, threading.get_ident(), items))
+            else:
+                self.dropped_events[name] = self.dropped_events.get(name, 0) + 1
+
+RECORDER = Recorder()
+
+class Stage:
+    '''
+    A stage being recorded, set its items attribute if they are only known at the end
+
+    Args:
+        name (str) : name of the stage
+        items (int) : number of items processed by the stage
+    '''
+    __slots__ = ('name', 'items', 'start_time', 'nested', 'peak')
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        active = RECORDER.active()
+        # a stage inside the same stage (e.g. gen_photo_mosaic -> compose_photo_mosaic) is counted once
+        self.nested = self.name in active
+        if not self.nested:
+            active.add(self.name)
+            RECORDER.begin(self)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_time = time.perf_counter()
+        if not self.nested:
+            RECORDER.active().discard(self.name)
+            RECORDER.end(self)
+            RECORDER.record(self.name, self.start_time, end_time, self.items, self.peak)
+
+class NullStage:
+    __slots__ = ('items',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_STAGE = NullStage()
+
+def enable(reset=True):
+    '''
+    Start recording the stages, forgetting the previous records if reset
+    '''
+    global _enabled
+    if reset:
+        RECORDER.reset()
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def stage(name, items=None):
+    '''
+    Context manager recording a stage, a no-op if the instrumentation is disabled
+
+        with instrumentation.stage('dataset scan') as scan:
+            pics = getfilespath(root_path)
+            scan.items = len(pics)
+
+    Args:
+        name (str) : name of the stage
+        items (int) : number of items processed by the stage
+
+    Returns:
+        stage (Stage or NullStage)
+    '''
+    if _enabled:
+        return Stage(name, items)
+    return NULL_STAGE
+
+def timed(name, items=None):
+    '''
+    Decorator recording each call of a function as a stage
+
+    Args:
+        name (str) : name of the stage
+        items (function) : number of items of a call computed from its first argument, e.g. len
+    '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Stage(name, items(args[0]) if items is not None and args else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    '''
+    Add value to a counter, a no-op if the instrumentation is disabled
+    '''
+    if _enabled:
+        with RECORDER.lock:
+            RECORDER.counters[name] = RECORDER.counters.get(name, 0) + value
+
+def record_stats(name, stats):
+    '''
+    Keep the last statistics of a component, e.g. the hits of a cache
+
+    Args:
+        name (str) : name of the component
+        stats (dict) : statistics, e.g. tile_cache.TileCache.stats()
+    '''
+    if _enabled:
+        with RECORDER.lock:
+            RECORDER.stats[name] = dict(stats)
+
+def report():
+    '''
+    Summary of the records
+
+    Returns:
+        report (dict) containing
+            wall_time (float) : seconds since enable
+            peak_rss_mb (float) : peak RSS of the process while recording
+            stages (dict) : per stage calls, seconds, items, items_per_second and peak_rss_mb
+            counters (dict) : see count
+            stats (dict) : see record_stats
+    '''
+    with RECORDER.lock:
+        stages = OrderedDict()
+        for name, stage_datas in RECORDER.stages.items():
+            stages[name] = dict(stage_datas)
+            seconds = stage_datas['seconds']
+            stages[name]['items_per_second'] = stage_datas['items']/seconds if stage_datas['items'] and seconds > 0 else None
+        RECORDER.read_peak()
+        return {
+            'wall_time': time.perf_counter() - RECORDER.start_time,
+            'peak_rss_mb': RECORDER.process_peak,
+            'stages': stages,
+            'counters': dict(RECORDER.counters),
+            'stats': dict(RECORDER.stats),
+        }
+
+def save_json(file_path):
+    with open(file_path, 'w') as report_file:
+        report_file.write(json.dumps(report(), indent=2))
+    print(file_path, 'saved')
+
+def save_trace(file_path):
+    '''
+    Save the recorded stages as a Chrome trace (JSON trace event format)
+    '''
+    with RECORDER.lock:
+        events = [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start_time - RECORDER.start_time)*1e6,
+            'dur': (end_time - start_time)*1e6,
+            'pid': 0,
+            'tid': thread_id,
+            'args': {'items': items} if items is not None else {},
+        } for name, start_time, end_time, thread_id, items in RECORDER.events]
+        dropped_events = dict(RECORDER.dropped_events)
+    with open(file_path, 'w') as trace_file:
+        trace_file.write(json.dumps({'traceEvents': events, 'otherData': {'dropped_events': dropped_events}}))
+    print(file_path, 'saved')
+
+class Sampler(threading.Thread):
+    '''
+    Sampling profiler thread counting the Python stacks of the other threads
+
+    Args:
+        interval (float) : seconds between two samples
+    '''
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, name='instrumentation-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append('{}:{}'.format(frame.f_code.co_filename.rsplit('/', 1)[-1], frame.f_code.co_name))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+_sampler = None
+
+def start_sampler(interval=0.005):
+    '''
+    Start the sampling profiler, see Sampler
+    '''
+    global _sampler
+    stop_sampler()
+    _sampler = Sampler(interval)
+    _sampler.start()
+
+def stop_sampler():
+    '''
+    Stop the sampling profiler
+
+    Returns:
+        stacks (dict) : number of samples of each collapsed stack, None if no sampler ran
+    '''
+    if _sampler is None:
+        return None
+    _sampler.stopped.set()
+    _sampler.join()
+    return _sampler.stacks
+
+def save_samples(file_path):
+    '''
+    Save the stacks of the last sampler in the collapsed format ("stack count" lines)
+    '''
+    stacks = stop_sampler() or {}
+    with open(file_path, 'w') as samples_file:
+        for stack, samples in sorted(stacks.items(), key=lambda item: -item[1]):
+            samples_file.write('{} {}\n'.format(stack, samples))
+    print(file_path, 'saved')
@@ -3,10 +3,20 @@ from PIL import Image
 from PIL import ImageStat
 from PIL import ImageDraw
 import json
-from colormath.color_objects import sRGBColor, LabColor
-from colormath.color_conversions import convert_color
-from colormath.color_diff import delta_e_cie2000
-import copy
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataset_cache import DatasetCache
+import color_diff
+from color_diff import rgb_to_lab
+from color_index import LabIndex
+import ordering
+from tile_cache import TileCache, load_tile, load_thumbnail
+from stream_render import open_strip_writer
+from palette_store import save_palette_store, PaletteStore
+from assignment import assign_tiles
+from match_lut import load_match_lut
+import instrumentation
 
 def getfilespath(root_path):
     '''
@@ -32,18 +42,36 @@ def extract_exif(image_path):
 
     Returns:
         a tuple which contains :
-            datepic (str) : date in the format YYYY:MM:DD HH:MM:SS
-            orientation (int) : from 1 to 8, refer to Exif spec for explanation
-            img_ratio (float) : aspect ratio of the image
+            datepic (str) : date in the format YYYY:MM:DD HH:MM:SS, None if missing
+            orientation (int) : from 1 to 8, refer to Exif spec for explanation, 1 if missing
+            img_ratio (float) : aspect ratio of the image, from the image size if missing
 
     '''
     with Image.open(image_path) as image:
-        infos = image._getexif()
-        # tags identified by ExifTags
-        datepic = infos[36867]
-        #modelcam = infos[272]
-        orientation = infos[274]
+        return read_exif(image)
+
+def read_exif(image):
+    '''
+    Get exif infos of an opened image, only the header of the file is read
+
+    Args:
+        image (PIL.Image.Image object) : image opened with Image.open, not loaded yet
+
+    Returns:
+        same tuple as extract_exif
+    '''
+    try:
+        infos = image._getexif() or {}
+    except (AttributeError, SyntaxError, OSError, ValueError):
+        infos = {}
+    # tags identified by ExifTags
+    datepic = infos.get(36867)
+    #modelcam = infos.get(272)
+    orientation = infos.get(274, 1)
+    if infos.get(40962) and infos.get(40963):
         img_ratio = infos[40962]/infos[40963]
+    else:
+        img_ratio = image.width/image.height
     return (datepic, orientation, img_ratio)
 
 class CustomStat(ImageStat.Stat):
@@ -82,12 +110,133 @@ def avg_rgb(image_arg):
         avg_r, avg_g, avg_b = map(int, CustomStat(image_arg)._getmean2())
     return (avg_r, avg_g, avg_b)
 
-def gen_dataset(root_path):
+def is_jpeg(pic_path):
+    file_extension = pic_path.split('.')[-1].lower()
+    return file_extension == 'jpg' or file_extension == 'jpeg'
+
+def analyze_pic(pic_path):
+    '''
+    Analyze one picture of the dataset
+
+    Args:
+        pic_path (str) : path of the picture
+
+    Returns:
+        pic_datas (tuple) containing
+            datepic (str)
+            orientation (int)
+            img_ratio (float)
+            avg_color (tuple) : (r, g, b) all floats 0.0 - 255.0
+            avg_lab (tuple) : (lab_l, lab_a, lab_b) all floats
+        or None if the picture is corrupted or missing
+    '''
+    try:
+        with instrumentation.stage('exif read', 1):
+            datepic, orientation, img_ratio = extract_exif(pic_path)
+        with instrumentation.stage('color averaging', 1):
+            avg_color = avg_rgb(pic_path)
+    except OSError:
+        # not an image, or deleted since the scan
+        print(pic_path, 'corrupted')
+        return None
+    if avg_color == 'corrupted':
+        return None
+    avg_color = tuple(map(float, avg_color))
+    avg_lab = tuple(rgb_to_lab(avg_color).tolist())
+    return (datepic, orientation, img_ratio, avg_color, avg_lab)
+
+def analyze_pic_fast(pic_path, draft_size=(64, 64)):
+    '''
+    Analyze one picture of the dataset, opening it once and decoding it at reduced size
+
+    The exif infos are read from the header, then the JPEG is decoded with
+    draft mode (DCT scaling, down to 1/8 of the size but not below draft_size)
+    and averaged like avg_rgb. See benchmarks/bench_fast_analysis.py for
+    the difference with the full resolution average.
+
+    Args:
+        pic_path (str) : path of the picture
+        draft_size (tuple) : minimal (width, height) of the reduced decode
+
+    Returns:
+        same as analyze_pic
+    '''
+    try:
+        with Image.open(pic_path) as image:
+            with instrumentation.stage('exif read', 1):
+                datepic, orientation, img_ratio = read_exif(image)
+            with instrumentation.stage('color averaging', 1):
+                image.draft('RGB', draft_size)
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                avg_color = tuple(float(int(value)) for value in CustomStat(image)._getmean2())
+    except OSError:
+        print(pic_path, 'corrupted')
+        return None
+    avg_lab = tuple(rgb_to_lab(avg_color).tolist())
+    return (datepic, orientation, img_ratio, avg_color, avg_lab)
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+def iter_files(root_path, extensions=None):
+    '''
+    Recursively yield the files of a folder as they are found
+
+    Same files in the same order as getfilespath, but the folders are read
+    one at a time with os.scandir, so the first files come right away and
+    the whole list is never held in memory. Files are filtered on their
+    name, without any stat call.
+
+    Args:
+        root_path (str) : path of the root folder
+        extensions (tuple) : lowercase extensions (with the dot) of the files to keep, all files if None
+
+    Yields:
+        file_path (str) : path of a file
+    '''
+    folders = [root_path]
+    while folders:
+        subfolders = []
+        try:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    # like os.walk, symbolic links to folders are neither files nor followed
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subfolders.append(entry.path)
+                    elif extensions is None or os.path.splitext(entry.name)[1].lower() in extensions:
+                        yield entry.path
+        except OSError:
+            continue
+        folders.extend(reversed(subfolders))
+
+def scan_dataset(root_path):
+    '''
+    Yield the JPEG pictures of the dataset as they are found, see iter_files
+    '''
+    pics = iter_files(root_path, JPEG_EXTENSIONS)
+    while True:
+        with instrumentation.stage('dataset scan') as scan:
+            pic = next(pics, None)
+            scan.items = 0 if pic is None else 1
+        if pic is None:
+            return
+        yield pic
+
+def gen_dataset(root_path, cache=None, analyze_function=analyze_pic, checkpoint_every=None):
     '''
     Generate the dataset
 
+    The pictures are analyzed while the folders are scanned. With a cache and
+    checkpoint_every, the new entries of the cache are added to its journal
+    every checkpoint_every analyzed pictures (see DatasetCache.checkpoint), so
+    an interrupted run resumes where it stopped.
+
     Args:
         root_path (str) : path of the root folder
+        cache (dataset_cache.DatasetCache) : optional analysis cache, only new or changed files are analyzed
+        analyze_function (function) : analyze_pic or analyze_pic_fast
+        checkpoint_every (int) : number of analyzed pictures between two checkpoints of the cache, no checkpoint if None
 
     Returns:
         pics_dict (dict) with
@@ -101,18 +250,90 @@ def gen_dataset(root_path):
 
     '''
     print('Generating dataset analysis')
-    raw_dataset = getfilespath(root_path)
+    pics = []
     pics_dict = {}
-    for pic in raw_dataset:
-        file_extension = pic.split('.')[-1].lower()
-        if file_extension == 'jpg' or file_extension == 'jpeg':
-            datepic, orientation, img_ratio = extract_exif(pic)
-            try:
-                avg_color = sRGBColor(*avg_rgb(pic))
-                avg_lab = convert_color(avg_color, LabColor)
-                pics_dict[pic] = (datepic, orientation, img_ratio, avg_color.get_value_tuple(), avg_lab.get_value_tuple())
-            except TypeError:
-                pass
+    analyzed = 0
+    with instrumentation.stage('dataset analysis') as analysis:
+        for pic in scan_dataset(root_path):
+            pics.append(pic)
+            found, pic_datas = cache.get(pic, analyze_function.__name__) if cache is not None else (False, None)
+            if not found:
+                pic_datas = analyze_function(pic)
+                analyzed += 1
+                if cache is not None:
+                    cache.put(pic, pic_datas, analyze_function.__name__)
+                    if checkpoint_every and analyzed % checkpoint_every == 0:
+                        cache.checkpoint()
+            if pic_datas is not None:
+                pics_dict[pic] = pic_datas
+        analysis.items = len(pics)
+    if cache is not None:
+        cache.prune(pics)
+        print('dataset cache', cache.stats())
+        instrumentation.record_stats('dataset cache', cache.stats())
+    return pics_dict
+
+def gen_dataset_parallel(root_path, workers=None, max_pending=None, cache=None, analyze_function=analyze_pic,
+                         checkpoint_every=None):
+    '''
+    Generate the dataset using a pool of worker processes
+
+    Pictures are submitted to the workers as soon as the scan finds them.
+
+    Args:
+        root_path (str) : path of the root folder
+        workers (int) : number of worker processes, defaults to the number of CPUs
+        max_pending (int) : maximal number of files submitted to the pool and not yet analyzed,
+            defaults to 4 times the number of workers
+        cache (dataset_cache.DatasetCache) : optional analysis cache, only new or changed files are analyzed
+        analyze_function (function) : analyze_pic or analyze_pic_fast
+        checkpoint_every (int) : see gen_dataset
+
+    Returns:
+        pics_dict (dict) : same dict as gen_dataset, in the same order
+    '''
+    print('Generating dataset analysis')
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 4*workers
+    pics = []
+    results = {}
+    pending = {}
+    analyzed = 0
+    start_time = time.time()
+    with instrumentation.stage('dataset analysis') as analysis, ProcessPoolExecutor(max_workers=workers) as executor:
+        pics_iter = scan_dataset(root_path)
+        while True:
+            for pic in pics_iter:
+                pics.append(pic)
+                found, pic_datas = cache.get(pic, analyze_function.__name__) if cache is not None else (False, None)
+                if found:
+                    results[pic] = pic_datas
+                    continue
+                pending[executor.submit(analyze_function, pic)] = pic
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pic = pending.pop(future)
+                results[pic] = future.result()
+                analyzed += 1
+                if cache is not None:
+                    cache.put(pic, results[pic], analyze_function.__name__)
+                    if checkpoint_every and analyzed % checkpoint_every == 0:
+                        cache.checkpoint()
+                elapsed = time.time() - start_time
+                print('[{} analyzed, {} found] {} ({:.1f} pics/s)'.format(analyzed, len(pics), pic, analyzed/max(elapsed, 1e-6)))
+        analysis.items = analyzed
+    if cache is not None:
+        cache.prune(pics)
+        print('dataset cache', cache.stats())
+        instrumentation.record_stats('dataset cache', cache.stats())
+    pics_dict = {}
+    for pic in pics:
+        if results[pic] is not None:
+            pics_dict[pic] = results[pic]
     return pics_dict
 
 def save_dict(datas_dict, file_path):
@@ -155,37 +376,52 @@ def NN_delta(dataset):
                                         avg_color (tuple) : (r, g, b) all floats 0.0 - 255.0
                                         avg_lab (tuple) : (lab_l, lab_a, lab_b) all floats
     '''
-    unsorted_datas = copy.copy(dataset)
-    black_rgb_color = sRGBColor(0, 0, 0)
-    black_lab_color = convert_color(black_rgb_color, LabColor)
-    darkest_pic, darkest_pic_datas = list(unsorted_datas.items())[0]
-    darkest_pic_color = LabColor(*darkest_pic_datas[-1])
-    for pic, pic_datas in unsorted_datas.items():
-        pic_lab_color = LabColor(*pic_datas[-1])
-        if delta_e_cie2000(black_lab_color, pic_lab_color) < delta_e_cie2000(black_lab_color, darkest_pic_color):
-            darkest_pic = pic
-            darkest_pic_color = pic_lab_color
+    pics = list(dataset.keys())
+    pics_labs = np.array([dataset[pic][-1] for pic in pics], dtype=np.float64)
+    black_lab_color = rgb_to_lab((0, 0, 0))
+    darkest_idx = int(np.argmin(color_diff.delta_e_cie2000(black_lab_color, pics_labs)))
+    remaining = np.ones(len(pics), dtype=bool)
     sorted_datas = []
-    first_key = darkest_pic
-    sorted_datas.append((first_key, unsorted_datas[first_key]))
-    del(unsorted_datas[first_key])
-    while len(unsorted_datas.keys()) > 0:
-        last_pic, last_pic_datas = sorted_datas[-1]
-        min_deltaE = 100
-        closest_pic = ''
-        for pic, data in unsorted_datas.items():
-            new_deltaE = delta_e_cie2000(LabColor(*last_pic_datas[-1]), LabColor(*data[-1]))
-            if new_deltaE < min_deltaE:
-                closest_pic = pic
-                min_deltaE = new_deltaE
-        try:
-            sorted_datas.append((closest_pic, unsorted_datas[closest_pic]))
-        except KeyError:
-            for pic, pic_data in unsorted_datas.items():
-                sorted_datas.append((pic, pic_data))
+    last_idx = darkest_idx
+    while True:
+        sorted_datas.append((pics[last_idx], dataset[pics[last_idx]]))
+        remaining[last_idx] = False
+        if not remaining.any():
             return sorted_datas
-        del(unsorted_datas[closest_pic])
-    return sorted_datas
+        deltas = color_diff.delta_e_cie2000(pics_labs[last_idx], pics_labs)
+        deltas[~remaining] = np.inf
+        last_idx = int(np.argmin(deltas))
+        if deltas[last_idx] >= 100:
+            for idx in np.flatnonzero(remaining):
+                sorted_datas.append((pics[idx], dataset[pics[idx]]))
+            return sorted_datas
+
+ORDERING_ENGINES = {
+    'nn_delta': NN_delta,
+    'nn_index': ordering.nn_index_order,
+    'hilbert': ordering.hilbert_order,
+}
+
+def sort_dataset(dataset, engine='nn_delta'):
+    '''
+    Sort dataset with one of the ORDERING_ENGINES
+
+    Args:
+        dataset (dict) : see NN_delta
+        engine (str) : name of the ordering engine
+            nn_delta : exact nearest neighbour tour on DeltaE00, O(n²)
+            nn_index : nearest neighbour tour driven by a LabIndex
+            hilbert : Hilbert curve through the Lab space
+
+    Returns:
+        sorted_datas (list) : see NN_delta
+    '''
+    try:
+        sort_function = ORDERING_ENGINES[engine]
+    except KeyError:
+        raise ValueError('unknown ordering engine {!r}, choose from {}'.format(engine, sorted(ORDERING_ENGINES)))
+    with instrumentation.stage('ordering', len(dataset)):
+        return sort_function(dataset)
 
 def gen_sorted_palette(sorted_datas):
     '''
@@ -320,15 +556,139 @@ def model_analysis(model_path, tile_width, tile_height, pic_maxsize):
                             all averages in the three R,G and B channels
 
     '''
-    tiles = tiling(model_path, tile_width, tile_height, pic_maxsize)
-    resized_model = resize_model(model_path, tile_width, tile_height, pic_maxsize)
+    resized_model, tiles_dict = analyze_model(model_path, tile_width, tile_height, pic_maxsize)
+    return tiles_dict
+
+def tiles_average(resized_model, tile_width, tile_height):
+    '''
+    Compute the average color of each tile of an already resized model image
+
+    Same averages as avg_rgb on each tile (root mean square of CustomStat),
+    computed in one block reduction over the pixels instead of one crop per tile.
+
+    Args:
+        resized_model (PIL.Image.Image object) : the model image resized by resize_model
+        tile_width (int) : width of the tile
+        tile_height (int) : height of the tile
+
+    Returns:
+        tiles_dict (dict) : see model_analysis
+    '''
+    if resized_model.mode != 'RGB':
+        resized_model = resized_model.convert('RGB')
+    pixels = np.asarray(resized_model, dtype=np.int64)
+    rows = resized_model.height//tile_height
+    cols = resized_model.width//tile_width
+    blocks = pixels[:rows*tile_height, :cols*tile_width].reshape(rows, tile_height, cols, tile_width, 3)
+    sum2 = (blocks*blocks).sum(axis=(1, 3))
+    averages = np.power(sum2/float(tile_width*tile_height), 0.5).astype(np.int64).tolist()
+    tiles_dict = {}
+    for row in range(rows):
+        y = row*tile_height
+        for col in range(cols):
+            x = col*tile_width
+            tiles_dict[(x, y, x+tile_width, y+tile_height)] = tuple(averages[row][col])
+    return tiles_dict
+
+def analyze_model(model_path, tile_width, tile_height, pic_maxsize):
+    '''
+    Decode and resize the model image once and compute the average color of its tiles
+
+    The result can be given as model_datas to basic_mosaic and photo_mosaic_datas
+    so that they don't decode the model image again.
+
+    Args:
+        model_path (str) : path of the image to resize
+        tile_width (int) : width of the tile
+        tile_height (int) : height of the tile
+        pic_maxsize (tuple) containing
+                maxwidth (int) : maximal width of the resized pic
+                maxheight (int) : maximal height of the resized pic
+
+    Returns:
+        model_datas (tuple) containing
+            resized_model (PIL.Image.Image object) : see resize_model
+            tiles_dict (dict) : see model_analysis
+    '''
+    with instrumentation.stage('tile analysis') as analysis:
+        resized_model = resize_model(model_path, tile_width, tile_height, pic_maxsize)
+        tiles_dict = tiles_average(resized_model, tile_width, tile_height)
+        analysis.items = len(tiles_dict)
+    return resized_model, tiles_dict
+
+def adaptive_tiles(resized_model, tile_width, tile_height, levels=2, max_variance=300.0):
+    '''
+    Quadtree tiling of an already resized model image
+
+    Starts from the tile_width x tile_height grid and splits in four the
+    tiles whose color variance is above max_variance, at most levels times,
+    so flat regions keep large tiles and detailed ones get small tiles. The
+    statistics of a tile are those of CustomStat (sum, sum2 and count of each
+    band), read from integral images so any tile costs O(1), and the tile
+    color is the same root mean square as tiles_average.
+
+    Args:
+        resized_model (PIL.Image.Image object) : the model image resized by resize_model
+        tile_width (int) : width of the largest tiles
+        tile_height (int) : height of the largest tiles
+        levels (int) : maximal number of splits, the smallest tiles are about
+            tile_width/2**levels x tile_height/2**levels
+        max_variance (float) : sum over the R, G and B bands of the variance above which a tile is split
+
+    Returns:
+        tiles_dict (dict) : see model_analysis, with tiles of mixed sizes
+    '''
+    if resized_model.mode != 'RGB':
+        resized_model = resized_model.convert('RGB')
+    pixels = np.asarray(resized_model, dtype=np.int64)
+    sums = np.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1, 3), dtype=np.int64)
+    sums2 = np.zeros_like(sums)
+    sums[1:, 1:] = pixels.cumsum(axis=0).cumsum(axis=1)
+    sums2[1:, 1:] = (pixels*pixels).cumsum(axis=0).cumsum(axis=1)
+    rows = resized_model.height//tile_height
+    cols = resized_model.width//tile_width
+    grid_y, grid_x = np.mgrid[0:rows, 0:cols]
+    boxes = np.stack([grid_x.ravel()*tile_width, grid_y.ravel()*tile_height,
+                      (grid_x.ravel() + 1)*tile_width, (grid_y.ravel() + 1)*tile_height], axis=1)
     tiles_dict = {}
-    for tile in tiles:
-        model_tile = resized_model.crop(tile)
-        tiles_dict[tile] = avg_rgb(model_tile)
+    for level in range(levels + 1):
+        x0, y0, x1, y1 = boxes.T
+        count = ((x1 - x0)*(y1 - y0))[:, None].astype(np.float64)
+        box_sum = sums[y1, x1] - sums[y0, x1] - sums[y1, x0] + sums[y0, x0]
+        box_sum2 = sums2[y1, x1] - sums2[y0, x1] - sums2[y1, x0] + sums2[y0, x0]
+        variance = (box_sum2/count - (box_sum/count)**2).sum(axis=1)
+        split = (variance > max_variance) & (x1 - x0 >= 2) & (y1 - y0 >= 2) if level < levels else np.zeros(len(boxes), dtype=bool)
+        averages = np.power(box_sum2/count, 0.5).astype(np.int64)
+        for box, average in zip(boxes[~split].tolist(), averages[~split].tolist()):
+            tiles_dict[tuple(box)] = tuple(average)
+        x0, y0, x1, y1 = boxes[split].T
+        xm, ym = (x0 + x1)//2, (y0 + y1)//2
+        boxes = np.concatenate([np.stack(corners, axis=1) for corners in
+                                [(x0, y0, xm, ym), (xm, y0, x1, ym), (x0, ym, xm, y1), (xm, ym, x1, y1)]])
     return tiles_dict
 
-def basic_mosaic(model_path, tile_width, tile_height, pic_maxsize):
+def analyze_model_adaptive(model_path, tile_width, tile_height, pic_maxsize, levels=2, max_variance=300.0):
+    '''
+    Same as analyze_model with the quadtree tiling of adaptive_tiles
+
+    The result can be given as model_datas to basic_mosaic and photo_mosaic_datas,
+    the photo mosaic renderers take the tile sizes from the boxes.
+
+    Args:
+        model_path, tile_width, tile_height, pic_maxsize : see analyze_model, tile_width and
+            tile_height are the size of the largest tiles
+        levels, max_variance : see adaptive_tiles
+
+    Returns:
+        model_datas (tuple) : see analyze_model
+    '''
+    with instrumentation.stage('tile analysis') as analysis:
+        resized_model = resize_model(model_path, tile_width, tile_height, pic_maxsize)
+        tiles_dict = adaptive_tiles(resized_model, tile_width, tile_height, levels, max_variance)
+        analysis.items = len(tiles_dict)
+    return resized_model, tiles_dict
+
+def basic_mosaic(model_path, tile_width, tile_height, pic_maxsize, model_datas=None, output_path='basic_mosaic.png'):
     '''
     Generate basic mosaic with computed colors
 
@@ -339,25 +699,26 @@ def basic_mosaic(model_path, tile_width, tile_height, pic_maxsize):
         pic_maxsize (tuple) containing
                 maxwidth (int) : maximal width of the resized pic
                 maxheight (int) : maximal height of the resized pic
+        model_datas (tuple) : result of analyze_model, computed from model_path if not given
+        output_path (str) : path of the basic mosaic picture
 
     Returns:
         message -> basic mosaic created
     '''
-    tiles_dict = model_analysis(model_path, tile_width, tile_height, pic_maxsize)
-    resized_model = resize_model(model_path, tile_width, tile_height, pic_maxsize)
+    resized_model, tiles_dict = model_datas or analyze_model(model_path, tile_width, tile_height, pic_maxsize)
     mosaic = Image.new(resized_model.mode, resized_model.size)
     draw_mosaic = ImageDraw.Draw(mosaic)
     for tile in tiles_dict.keys():
         draw_mosaic.rectangle(tile, fill=tiles_dict[tile])
-    mosaic.save('basic_mosaic.png')
+    mosaic.save(output_path)
     return 'basic mosaic created'
 
-def closest_pic(tile_color, sorted_palette):
+def closest_pic(tile_lab, sorted_palette):
     '''
     Get the path of the pic with the closest color to the color in argument
 
     Args:
-        tile_color (colormath.color_objects.LabColor object) : color to compare the sorted_palette to
+        tile_lab (array_like) : (lab_l, lab_a, lab_b) color to compare the sorted_palette to
         sorted_palette (list) : list of tuples containing
                                    pic_path (str) : path of the pic in the dataset
                                    pic_datas (tuple) containing
@@ -370,17 +731,15 @@ def closest_pic(tile_color, sorted_palette):
     Returns:
         pic_path (str) : path of the pic with the closest color
     '''
+    tile_lab = np.asarray(tile_lab, dtype=np.float64)
     min_idx = 0
     max_idx = len(sorted_palette) - 1
     deltaE_threshold = 1
     while max_idx - min_idx > 1:
         min_path, min_datas = sorted_palette[min_idx]
-        min_color = LabColor(*min_datas[-1])
         max_path, max_datas = sorted_palette[max_idx]
-        max_color = LabColor(*max_datas[-1])
         middle_idx = (min_idx + max_idx)//2
-        delta_to_min = delta_e_cie2000(min_color, tile_color)
-        delta_to_max = delta_e_cie2000(max_color, tile_color)
+        delta_to_min, delta_to_max = color_diff.delta_e_cie2000(tile_lab, np.array([min_datas[-1], max_datas[-1]])).tolist()
         if delta_to_min < deltaE_threshold:
             chosen_idx = min_idx
             break
@@ -396,7 +755,8 @@ def closest_pic(tile_color, sorted_palette):
     pic_path, pic_datas = sorted_palette[chosen_idx]
     return pic_path
 
-def photo_mosaic_datas(model_path, sorted_pics_list, tile_width, tile_height, pic_maxsize):
+def photo_mosaic_datas(model_path, sorted_pics_list, tile_width, tile_height, pic_maxsize, index=None, model_datas=None,
+                       max_uses=None, min_distance=None, lut=None):
     '''
     Generates the datas for the result image by matching tiles from the model image with pics from the dataset
 
@@ -410,11 +770,20 @@ def photo_mosaic_datas(model_path, sorted_pics_list, tile_width, tile_height, pi
                                         img_ratio (float)
                                         avg_color (tuple) : (r, g, b) all floats 0.0 - 1.0
                                         avg_lab (tuple) : (lab_l, lab_a, lab_b) all floats
+            see NN_delta, only used without index (can be None if index is given)
         tile_width (int) : width of the tile
         tile_height (int) : height of the tile
         pic_maxsize (tuple) containing
                 maxwidth (int) : maximal width of the resized pic
                 maxheight (int) : maximal height of the resized pic
+        index (color_index.LabIndex) : nearest color index of the dataset, used instead of
+            the bisection of closest_pic on sorted_pics_list if given
+        model_datas (tuple) : result of analyze_model, computed from model_path if not given
+        max_uses (int) : maximal number of tiles using the same pic, see assignment.assign_tiles
+        min_distance (float) : minimal distance in pixels of the resized model between two tiles
+            using the same pic, see assignment.assign_tiles
+        lut (match_lut.MatchLUT) : lookup table of the matches of tile colors, used instead of
+            index when there is no usage constraint
 
     Returns:
         mosaic_datas (dict) with
@@ -426,16 +795,87 @@ def photo_mosaic_datas(model_path, sorted_pics_list, tile_width, tile_height, pi
                 values:
                     close_pic (str) : path of a pic with a color close to the one from the model image's tile
     '''
-    tiles_dict = model_analysis(model_path, tile_width, tile_height, pic_maxsize)
+    resized_model, tiles_dict = model_datas or analyze_model(model_path, tile_width, tile_height, pic_maxsize)
+    tiles = list(tiles_dict.keys())
+    tiles_labs = rgb_to_lab([tiles_dict[tile] for tile in tiles])
     mosaic_datas = {}
-    for tile in tiles_dict.keys():
-        tile_color = convert_color(sRGBColor(*tiles_dict[tile]), LabColor)
-        close_pic = closest_pic(tile_color, sorted_pics_list)
-        mosaic_datas[tile] = close_pic
+    with instrumentation.stage('matching', len(tiles)):
+        if max_uses is not None or min_distance is not None:
+            if index is None:
+                index = LabIndex.from_dataset(sorted_pics_list)
+            assigned, violations = assign_tiles(tiles_labs, tiles, index, max_uses=max_uses, min_distance=min_distance)
+            if violations:
+                print(violations, 'tiles could not satisfy the usage constraints')
+                instrumentation.count('constraint violations', violations)
+            for tile, pic_idx in zip(tiles, assigned):
+                mosaic_datas[tile] = index.paths[pic_idx]
+        elif lut is not None:
+            for tile, close_pic in zip(tiles, lut.closest_batch([tiles_dict[tile] for tile in tiles])):
+                mosaic_datas[tile] = close_pic
+            instrumentation.record_stats('match lut', lut.stats())
+        elif index is not None:
+            for tile, close_pic in zip(tiles, index.closest_batch(tiles_labs)):
+                mosaic_datas[tile] = close_pic
+        else:
+            for tile, tile_lab in zip(tiles, tiles_labs):
+                close_pic = closest_pic(tile_lab, sorted_pics_list)
+                mosaic_datas[tile] = close_pic
     print('photo_mosaic_data generated')
     return mosaic_datas
 
-def gen_photo_mosaic(photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale=1):
+def photo_mosaic_size(tile_width, tile_height, pic_maxsize, scale=1):
+    new_width = pic_maxsize[0]
+    new_height = int(new_width/(tile_width/tile_height))
+    new_width = (new_width//tile_width)*tile_width*scale
+    new_height = (new_height//tile_height)*tile_height*scale
+    return (new_width, new_height)
+
+def render_tile(pic_path, tile_size, cache_dir=None):
+    '''
+    Load a tile in a worker of gen_photo_mosaic_parallel
+
+    Args:
+        pic_path (str) : path of the picture
+        tile_size (tuple) : (width, height) of the tile
+        cache_dir (str) : directory of the on-disk thumbnails of a TileCache, if any
+
+    Returns:
+        (tile_bytes, from_disk) :
+            tile_bytes (bytes) : RGB pixels of the tile
+            from_disk (bool) : True if the tile came from an on-disk thumbnail
+    '''
+    if cache_dir is not None:
+        tile_pic, from_disk = load_thumbnail(pic_path, tile_size, cache_dir)
+    else:
+        tile_pic, from_disk = load_tile(pic_path, tile_size), False
+    return tile_pic.tobytes(), from_disk
+
+@instrumentation.timed('render', items=len)
+def compose_photo_mosaic(photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale=1, tile_cache=None):
+    '''
+    Paste the tiles of the photo mosaic in memory, without saving it
+
+    Args:
+        photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale, tile_cache : see gen_photo_mosaic
+
+    Returns:
+        mosaic (PIL.Image.Image object) : the photo mosaic picture
+    '''
+    mosaic = Image.new('RGB', photo_mosaic_size(tile_width, tile_height, pic_maxsize, scale))
+    for box, path in photo_mosaic_data.items():
+        new_box = tuple(coord*scale for coord in box)
+        # tiles of mixed sizes (see adaptive_tiles) are resized to their own box
+        new_tile_size = (new_box[2] - new_box[0], new_box[3] - new_box[1])
+        if tile_cache is not None:
+            tile_pic = tile_cache.get(path, new_tile_size)
+        else:
+            tile_pic = load_tile(path, new_tile_size)
+        mosaic.paste(tile_pic, new_box)
+    return mosaic
+
+@instrumentation.timed('render', items=len)
+def gen_photo_mosaic(photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale=1, tile_cache=None,
+                     output_path='photo_mosaic.png'):
     '''
     Generate the photo mosaic picture
 
@@ -454,43 +894,147 @@ def gen_photo_mosaic(photo_mosaic_data, tile_width, tile_height, pic_maxsize, sc
                 maxwidth (int) : maximal width of the resized pic
                 maxheight (int) : maximal height of the resized pic
         scale (int) : scale factor between the tile's size and the actual tile's picture's size
+        tile_cache (tile_cache.TileCache) : cache of the resized pictures, every tile is decoded if None
+        output_path (str) : path of the photo mosaic picture
 
     Returns: message -> photo mosaic created
 
     '''
-    new_width = pic_maxsize[0]
-    new_height = int(new_width/(tile_width/tile_height))
-    new_width = (new_width//tile_width)*tile_width*scale
-    new_height = (new_height//tile_height)*tile_height*scale
-    mosaic = Image.new('RGB', (new_width, new_height))
+    mosaic = compose_photo_mosaic(photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale, tile_cache)
+    if tile_cache is not None:
+        print('tile cache', tile_cache.stats())
+        instrumentation.record_stats('tile cache', tile_cache.stats())
+    mosaic.save(output_path)
+    return('photo mosaic created')
+
+@instrumentation.timed('render', items=len)
+def gen_photo_mosaic_parallel(photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale=1,
+                              tile_cache=None, workers=None, max_pending=None, use_threads=False,
+                              output_path='photo_mosaic.png'):
+    '''
+    Generate the photo mosaic picture, loading and resizing tiles in parallel
+
+    Tiles are grouped by picture and tile size so each of them is decoded once, workers
+    return the resized tiles and this process pastes them. The output is
+    pixel identical to gen_photo_mosaic.
+
+    Args:
+        photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale, tile_cache, output_path : see gen_photo_mosaic
+        workers (int) : number of workers, defaults to the number of CPUs
+        max_pending (int) : maximal number of tiles loaded and not yet pasted,
+            defaults to 4 times the number of workers
+        use_threads (bool) : use a pool of threads instead of processes
+
+    Returns: message -> photo mosaic created
+    '''
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 4*workers
+    cache_dir = tile_cache.cache_dir if tile_cache is not None else None
+    paths_boxes = {}
     for box, path in photo_mosaic_data.items():
-        with Image.open(path) as pic:
-            new_tile_width = tile_width*scale
-            new_tile_height = tile_height*scale
-            pic.draft(pic.mode, (new_tile_width*2, new_tile_height*2))
-            tile_pic = pic.resize((tile_width*scale, tile_height*scale))
-            new_box = tuple(coord*scale for coord in box)
-            mosaic.paste(tile_pic, new_box)
-    mosaic.save('photo_mosaic.png')
+        new_box = tuple(coord*scale for coord in box)
+        new_tile_size = (new_box[2] - new_box[0], new_box[3] - new_box[1])
+        paths_boxes.setdefault((path, new_tile_size), []).append(new_box)
+    mosaic = Image.new('RGB', photo_mosaic_size(tile_width, tile_height, pic_maxsize, scale))
+    pool_executor = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    pending = {}
+    with pool_executor(max_workers=workers) as executor:
+        paths_iter = iter(paths_boxes.items())
+        while True:
+            for (path, new_tile_size), boxes in paths_iter:
+                tile_pic = tile_cache.get_memory(path, new_tile_size) if tile_cache is not None else None
+                if tile_pic is not None:
+                    for new_box in boxes:
+                        mosaic.paste(tile_pic, new_box)
+                    continue
+                pending[executor.submit(render_tile, path, new_tile_size, cache_dir)] = (path, new_tile_size)
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, new_tile_size = pending.pop(future)
+                tile_bytes, from_disk = future.result()
+                tile_pic = Image.frombytes('RGB', new_tile_size, tile_bytes)
+                if tile_cache is not None:
+                    tile_cache.add(path, new_tile_size, tile_pic, from_disk)
+                for new_box in paths_boxes[(path, new_tile_size)]:
+                    mosaic.paste(tile_pic, new_box)
+    if tile_cache is not None:
+        print('tile cache', tile_cache.stats())
+        instrumentation.record_stats('tile cache', tile_cache.stats())
+    mosaic.save(output_path)
+    return('photo mosaic created')
+
+@instrumentation.timed('render', items=len)
+def gen_photo_mosaic_streaming(photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale=1,
+                               tile_cache=None, output_path='photo_mosaic.png', band_rows=1):
+    '''
+    Generate the photo mosaic picture one band of tiles at a time
+
+    Each band is written to output_path as soon as it is composed (see
+    stream_render), so the peak memory is about one band plus the tile cache
+    instead of the whole picture. Same pixels as gen_photo_mosaic.
+
+    Args:
+        photo_mosaic_data, tile_width, tile_height, pic_maxsize, scale : see gen_photo_mosaic
+        tile_cache (tile_cache.TileCache) : cache of the resized pictures, a small in-memory one is used if None
+        output_path (str) : .png, .ppm or .pnm file, read it back with stream_render.read_region
+        band_rows (int) : number of rows of tiles in a band
+
+    Returns: message -> photo mosaic created
+    '''
+    if tile_cache is None:
+        tile_cache = TileCache(max_bytes=64*1024*1024)
+    mosaic_size = photo_mosaic_size(tile_width, tile_height, pic_maxsize, scale)
+    band_height = tile_height*scale*band_rows
+    bands_tiles = {}
+    for box, path in photo_mosaic_data.items():
+        new_box = tuple(coord*scale for coord in box)
+        for band_idx in range(new_box[1]//band_height, (new_box[3] - 1)//band_height + 1):
+            bands_tiles.setdefault(band_idx, []).append((new_box, path))
+    with open_strip_writer(output_path, mosaic_size) as writer:
+        for band_top in range(0, mosaic_size[1], band_height):
+            band = Image.new('RGB', (mosaic_size[0], min(band_height, mosaic_size[1] - band_top)))
+            for new_box, path in bands_tiles.pop(band_top//band_height, []):
+                tile_pic = tile_cache.get(path, (new_box[2] - new_box[0], new_box[3] - new_box[1]))
+                band.paste(tile_pic, (new_box[0], new_box[1] - band_top))
+            writer.write(band)
+    print('tile cache', tile_cache.stats())
+    instrumentation.record_stats('tile cache', tile_cache.stats())
     return('photo mosaic created')
 
 if __name__ == '__main__':
 
-    if not os.path.exists('analyzed_dataset.txt'):
-        datas = gen_dataset('dataset')
-        save_dict(datas, 'analyzed_dataset.txt')
-        pics_dict = datas
-    else:
-        pics_dict = open_dict('analyzed_dataset.txt')
+    ordering_engine = 'nn_index'
+    # record the time, items and memory of each stage, see instrumentation
+    instrumented = False
+    sampling_profiler = False
+    if instrumented:
+        instrumentation.enable()
+    if sampling_profiler:
+        instrumentation.start_sampler()
+
+    cache = DatasetCache('dataset_cache.json')
+    pics_dict = gen_dataset_parallel('dataset', cache=cache, analyze_function=analyze_pic_fast, checkpoint_every=1000)
+    if cache.dirty:
+        cache.save()
+    if cache.outdated('analyzed_dataset.txt'):
+        save_dict(pics_dict, 'analyzed_dataset.txt')
 
-    if not os.path.exists('sorted_dataset.txt'):
+    # the ordering and the tile map are read back from the palette store, the json files are only written
+    store_path = 'palette_store'
+    store = None if cache.outdated(os.path.join(store_path, 'meta.json')) else PaletteStore(store_path)
+    store_outdated = store is None
+    if store is None or store.order is None or cache.outdated('sorted_dataset.txt'):
         with open('sorted_dataset.txt', 'w') as dataset_file:
-            sorted_pics_list = NN_delta(pics_dict)
+            sorted_pics_list = sort_dataset(pics_dict, ordering_engine)
             dataset_file.write(json.dumps(sorted_pics_list))
-            print('dataset sorted by DeltaE00')
+            print('dataset sorted with', ordering_engine)
+        store_outdated = True
     else:
-        with open('sorted_dataset.txt', 'r') as dataset_file:
-            sorted_pics_list = [tuple(data) for data in json.loads(dataset_file.read())]
+        sorted_pics_list = store.sorted_pics_list()
 
     gen_sorted_palette(sorted_pics_list)
 
@@ -499,13 +1043,34 @@ if __name__ == '__main__':
     tile_width = 12
     tile_height = int(tile_width/tile_ratio)
     pic_maxsize = (1024, 1024)
+    # > 0 : quadtree tiles from tile_width*2**adaptive_levels down to tile_width, see adaptive_tiles
+    adaptive_levels = 0
 
-    print(basic_mosaic(model_path, tile_width, tile_height, pic_maxsize))
+    if adaptive_levels:
+        tile_width, tile_height = tile_width*2**adaptive_levels, tile_height*2**adaptive_levels
+        model_datas = analyze_model_adaptive(model_path, tile_width, tile_height, pic_maxsize, levels=adaptive_levels)
+    else:
+        model_datas = analyze_model(model_path, tile_width, tile_height, pic_maxsize)
+    print(basic_mosaic(model_path, tile_width, tile_height, pic_maxsize, model_datas=model_datas))
 
-    if not os.path.exists('mosaic_datas.txt'):
-        mosaic_dict = photo_mosaic_datas(model_path, sorted_pics_list, tile_width, tile_height, pic_maxsize)
+    if store is None or store.tiles is None or cache.outdated('mosaic_datas.txt'):
+        index = LabIndex.from_dataset(pics_dict)
+        lut = load_match_lut('match_lut.npz', index)
+        mosaic_dict = photo_mosaic_datas(model_path, sorted_pics_list, tile_width, tile_height, pic_maxsize, index=index,
+                                         model_datas=model_datas, lut=lut)
         save_dict(mosaic_dict, 'mosaic_datas.txt')
+        lut.save('match_lut.npz')
+        store_outdated = True
     else:
-        mosaic_dict = open_dict('mosaic_datas.txt')
+        mosaic_dict = store.mosaic_datas()
+    if store_outdated:
+        save_palette_store(store_path, pics_dict, sorted_pics_list, mosaic_dict)
+
+    tile_cache = TileCache(cache_dir='tile_cache')
+    print(gen_photo_mosaic_parallel(mosaic_dict, tile_width, tile_height, pic_maxsize, scale=10, tile_cache=tile_cache))
 
-    print(gen_photo_mosaic(mosaic_dict, tile_width, tile_height, pic_maxsize, scale=10))
+    if instrumented:
+        instrumentation.save_json('instrumentation.json')
+        instrumentation.save_trace('instrumentation_trace.json')
+    if sampling_profiler:
+        instrumentation.save_samples('profile_samples.txt')
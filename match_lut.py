@@ -0,0 +1,158 @@
+'''
+Lookup table from tile RGB colors to their closest picture of the palette
+
+Tile averages are 8 bits RGB triples, and the tiles of a model (or of the
+frames of a video) repeat the same colors a lot. MatchLUT memoizes the
+result of LabIndex.closest_index for each RGB cell, so a color already seen
+costs one dict lookup instead of a Lab conversion and an index query.
+
+With bits=8 a cell is one RGB color and the matches are exactly those of
+LabIndex.closest. With fewer bits per channel, colors are quantized to the
+center of their cell before matching: fewer distinct cells, more hits, and
+precompute() can fill the whole grid ((2**bits)**3 cells) ahead of time.
+
+The table is saved next to the dataset with the fingerprint of the library
+it was built for, load_match_lut ignores a table whose library changed.
+'''
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from color_diff import rgb_to_lab
+
+LUT_VERSION = 1
+
+def library_fingerprint(index):
+    '''
+    Hash of the paths and Lab colors of an indexed palette
+
+    Args:
+        index (color_index.LabIndex) : the palette
+
+    Returns:
+        hexdigest (str) : sha1 of the palette, changes whenever a picture is added, removed or re-analyzed
+    '''
+    sha1 = hashlib.sha1()
+    sha1.update('\n'.join(index.paths).encode('utf-8'))
+    sha1.update(np.ascontiguousarray(index.labs, dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+class MatchLUT:
+    '''
+    Args:
+        index (color_index.LabIndex) : nearest color index of the palette
+        bits (int) : bits per RGB channel of a cell, 8 for exact matches
+        k (int) : number of DeltaE76 candidates re-ranked with DeltaE00, see LabIndex.closest
+        fingerprint (str) : library_fingerprint(index), computed if None
+    '''
+    def __init__(self, index, bits=8, k=8, fingerprint=None):
+        if not 1 <= bits <= 8:
+            raise ValueError('bits must be between 1 and 8, not {}'.format(bits))
+        self.index = index
+        self.bits = bits
+        self.k = k
+        self.fingerprint = fingerprint or library_fingerprint(index)
+        self.cells = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def cell_keys(self, rgbs):
+        shift = 8 - self.bits
+        cells = np.asarray(rgbs, dtype=np.int64).reshape(-1, 3) >> shift
+        return (cells[:, 0] << 2*self.bits) | (cells[:, 1] << self.bits) | cells[:, 2]
+
+    def cell_colors(self, keys):
+        '''
+        RGB color of the center of cells (the color itself with 8 bits)
+        '''
+        mask = (1 << self.bits) - 1
+        cells = np.stack([(keys >> 2*self.bits) & mask, (keys >> self.bits) & mask, keys & mask], axis=1)
+        shift = 8 - self.bits
+        return ((cells << shift) + ((1 << shift) >> 1)).astype(np.float64)
+
+    def fill(self, keys):
+        labs = rgb_to_lab(self.cell_colors(np.asarray(keys, dtype=np.int64)))
+        matches = {key: self.index.closest_index(lab, self.k) for key, lab in zip(keys, labs)}
+        with self.lock:
+            self.cells.update(matches)
+
+    def closest_index_batch(self, rgbs):
+        '''
+        Palette indices of the closest pictures of RGB colors
+
+        Args:
+            rgbs (array_like) : (T, 3) RGB colors, ints between 0 and 255
+
+        Returns:
+            pics_idx (numpy.ndarray) : (T,) indices in index.paths
+        '''
+        keys = self.cell_keys(rgbs).tolist()
+        missing = list(set(key for key in keys if key not in self.cells))
+        if missing:
+            self.fill(missing)
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        cells = self.cells
+        return np.array([cells[key] for key in keys], dtype=np.int64)
+
+    def closest_batch(self, rgbs):
+        '''
+        Paths of the closest pictures of RGB colors, see closest_index_batch
+        '''
+        return [self.index.paths[pic_idx] for pic_idx in self.closest_index_batch(rgbs)]
+
+    def precompute(self):
+        '''
+        Fill every cell of the grid, (2**bits)**3 index queries
+        '''
+        if self.bits > 6:
+            raise ValueError('precompute would query {} cells, use 6 bits or less'.format(1 << 3*self.bits))
+        self.fill([key for key in range(1 << 3*self.bits) if key not in self.cells])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'cells': len(self.cells),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits/lookups if lookups else 0.0,
+        }
+
+    def save(self, lut_path):
+        '''
+        Save the filled cells and the settings of the table in a .npz file
+        '''
+        with self.lock:
+            keys = np.array(sorted(self.cells), dtype=np.int64)
+            pics_idx = np.array([self.cells[key] for key in keys.tolist()], dtype=np.int64)
+        meta = {'version': LUT_VERSION, 'fingerprint': self.fingerprint, 'bits': self.bits, 'k': self.k}
+        temp_path = '{}.{}.tmp.npz'.format(lut_path, os.getpid())
+        np.savez(temp_path, keys=keys, pics_idx=pics_idx, meta=np.array(json.dumps(meta)))
+        os.replace(temp_path, lut_path)
+        print(lut_path, 'saved')
+
+def load_match_lut(lut_path, index, bits=8, k=8):
+    '''
+    Load a saved MatchLUT, or start an empty one if it is missing or stale
+
+    Args:
+        lut_path (str) : path of the .npz file written by MatchLUT.save
+        index (color_index.LabIndex) : nearest color index of the current palette
+        bits (int), k (int) : see MatchLUT
+
+    Returns:
+        lut (MatchLUT) : the saved cells if the table was built for the same library
+            and settings, no cell otherwise
+    '''
+    lut = MatchLUT(index, bits, k)
+    if not os.path.exists(lut_path):
+        return lut
+    with np.load(lut_path) as saved:
+        meta = json.loads(str(saved['meta']))
+        if meta != {'version': LUT_VERSION, 'fingerprint': lut.fingerprint, 'bits': bits, 'k': k}:
+            print(lut_path, 'is stale, rebuilding it')
+            return lut
+        lut.cells = dict(zip(saved['keys'].tolist(), saved['pics_idx'].tolist()))
+    return lut
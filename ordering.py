@@ -0,0 +1,111 @@
+'''
+Palette ordering engines
+
+Each engine takes a pics_dict (see main.gen_dataset) and returns a
+sorted_datas list like main.NN_delta, so gen_sorted_palette works with any
+of them. See main.ORDERING_ENGINES to select one by name.
+'''
+import numpy as np
+import color_diff
+from color_index import LabIndex
+
+def darkest_idx(pics_labs):
+    black_lab_color = color_diff.rgb_to_lab((0, 0, 0))
+    return int(np.argmin(color_diff.delta_e_cie2000(black_lab_color, pics_labs)))
+
+def nn_index_order(dataset, k=8):
+    '''
+    Sort dataset using Nearest neighbour algorithm accelerated by a LabIndex
+
+    Approximation of NN_delta: the tour also starts with the darkest pic, but
+    each step only compares with DeltaE00 the k nearest remaining pics for
+    DeltaE76 instead of all the remaining pics, so the whole tour is about
+    O(n log n). A step differs from NN_delta when the DeltaE00 nearest
+    remaining pic is not among these k candidates (DeltaE00 and DeltaE76 don't
+    rank colors the same way), or between pics at the same DeltaE00, and the
+    rest of the tour follows from there. As in NN_delta, when the next pic is
+    at least 100 DeltaE00 away, the remaining pics are appended in dataset order.
+
+    Args:
+        dataset (dict) : pics_dict, see main.gen_dataset
+        k (int) : number of DeltaE76 candidates re-ranked with DeltaE00 at each step
+
+    Returns:
+        sorted_datas (list) : list of (pic_path, pic_datas) tuples, see main.NN_delta
+    '''
+    index = LabIndex.from_dataset(dataset)
+    current_idx = darkest_idx(index.labs)
+    remaining = np.ones(len(index), dtype=bool)
+    sorted_datas = []
+    while True:
+        sorted_datas.append((index.paths[current_idx], dataset[index.paths[current_idx]]))
+        index.remove(current_idx)
+        remaining[current_idx] = False
+        if len(sorted_datas) == len(index):
+            return sorted_datas
+        next_idx = index.closest_index(index.labs[current_idx], k)
+        if color_diff.delta_e_cie2000(index.labs[current_idx], index.labs[next_idx:next_idx + 1])[0] >= 100:
+            for idx in np.flatnonzero(remaining):
+                sorted_datas.append((index.paths[idx], dataset[index.paths[idx]]))
+            return sorted_datas
+        current_idx = next_idx
+
+def hilbert_index(coords, bits):
+    '''
+    Position of points along a 3D Hilbert curve (Skilling's algorithm)
+
+    Args:
+        coords (numpy.ndarray) : (N, 3) integer coordinates between 0 and 2**bits - 1
+        bits (int) : number of bits per coordinate, at most 21
+
+    Returns:
+        hilbert_idx (numpy.ndarray) : (N,) uint64 positions along the curve
+    '''
+    axes = [coords[:, axis].astype(np.uint64) for axis in range(3)]
+    highest_bit = np.uint64(1 << (bits - 1))
+    # undo excess work
+    bit = highest_bit
+    while bit > 1:
+        low_bits = bit - np.uint64(1)
+        for axis in range(3):
+            is_set = (axes[axis] & bit) != 0
+            axes[0] = np.where(is_set, axes[0] ^ low_bits, axes[0])
+            swapped = np.where(is_set, np.uint64(0), (axes[0] ^ axes[axis]) & low_bits)
+            axes[0] = axes[0] ^ swapped
+            axes[axis] = axes[axis] ^ swapped
+        bit = bit >> np.uint64(1)
+    # gray encode
+    for axis in range(1, 3):
+        axes[axis] = axes[axis] ^ axes[axis - 1]
+    flips = np.zeros(len(coords), dtype=np.uint64)
+    bit = highest_bit
+    while bit > 1:
+        flips = np.where((axes[2] & bit) != 0, flips ^ (bit - np.uint64(1)), flips)
+        bit = bit >> np.uint64(1)
+    axes = [axis_coords ^ flips for axis_coords in axes]
+    # interleave the bits of the transposed index
+    hilbert_idx = np.zeros(len(coords), dtype=np.uint64)
+    for bit_idx in range(bits - 1, -1, -1):
+        for axis in range(3):
+            hilbert_idx = (hilbert_idx << np.uint64(1)) | ((axes[axis] >> np.uint64(bit_idx)) & np.uint64(1))
+    return hilbert_idx
+
+def hilbert_order(dataset, bits=10):
+    '''
+    Sort dataset along a Hilbert curve filling the Lab bounding box of the dataset
+
+    Args:
+        dataset (dict) : pics_dict, see main.gen_dataset
+        bits (int) : resolution of the curve, 2**bits cells per Lab axis
+
+    Returns:
+        sorted_datas (list) : list of (pic_path, pic_datas) tuples, see main.NN_delta
+    '''
+    pics = list(dataset.keys())
+    pics_labs = np.array([dataset[pic][-1] for pic in pics], dtype=np.float64).reshape(-1, 3)
+    low = pics_labs.min(axis=0)
+    span = np.maximum(pics_labs.max(axis=0) - low, 1e-12).max()
+    cells = (1 << bits) - 1
+    coords = np.round((pics_labs - low)/span*cells).astype(np.int64)
+    order = np.argsort(hilbert_index(coords, bits), kind='mergesort')
+    return [(pics[idx], dataset[pics[idx]]) for idx in order]
@@ -0,0 +1,148 @@
+'''
+Compact columnar storage of the analyzed dataset
+
+A palette store is a directory of .npy files which can be memory-mapped, so
+loading it creates no Python object per picture:
+    labs.npy (N, 3) float64 : avg_lab
+    rgbs.npy (N, 3) float64 : avg_color
+    ratios.npy (N,) float64 : img_ratio
+    orientations.npy (N,) int16 : orientation, 0 if unknown
+    dates.npy (N,) S19 : datepic, empty if unknown
+    paths.npy (bytes) uint8 and paths_offsets.npy (N + 1,) int64 : utf-8 path string table
+and optionally
+    order.npy (N,) int64 : ordering permutation (see main.sort_dataset)
+    tiles.npy (T, 4) int32 and tiles_pics.npy (T,) int64 : tile -> picture map
+'''
+import os
+import json
+import numpy as np
+
+STORE_VERSION = 1
+
+def save_palette_store(store_path, pics_dict, sorted_pics_list=None, mosaic_datas=None):
+    '''
+    Save a dataset in a palette store
+
+    Args:
+        store_path (str) : path of the store directory, created if needed
+        pics_dict (dict) : see main.gen_dataset
+        sorted_pics_list (list) : optional ordering of pics_dict, see main.NN_delta
+        mosaic_datas (dict) : optional tile -> pic_path map, see main.photo_mosaic_datas
+    '''
+    os.makedirs(store_path, exist_ok=True)
+    pics = list(pics_dict.keys())
+    count = len(pics)
+    labs = np.empty((count, 3))
+    rgbs = np.empty((count, 3))
+    ratios = np.empty(count)
+    orientations = np.zeros(count, dtype=np.int16)
+    dates = np.zeros(count, dtype='S19')
+    for idx, pic in enumerate(pics):
+        datepic, orientation, img_ratio, avg_color, avg_lab = pics_dict[pic]
+        labs[idx] = avg_lab
+        rgbs[idx] = avg_color
+        ratios[idx] = img_ratio if img_ratio is not None else np.nan
+        orientations[idx] = orientation or 0
+        dates[idx] = (datepic or '').encode('ascii', 'replace')
+    encoded_paths = [pic.encode('utf-8') for pic in pics]
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(encoded_path) for encoded_path in encoded_paths])
+    arrays = {
+        'labs': labs,
+        'rgbs': rgbs,
+        'ratios': ratios,
+        'orientations': orientations,
+        'dates': dates,
+        'paths': np.frombuffer(b''.join(encoded_paths), dtype=np.uint8),
+        'paths_offsets': offsets,
+    }
+    pics_idx = {pic: idx for idx, pic in enumerate(pics)}
+    if sorted_pics_list is not None:
+        arrays['order'] = np.array([pics_idx[pic] for pic, pic_datas in sorted_pics_list], dtype=np.int64)
+    if mosaic_datas is not None:
+        tiles = list(mosaic_datas.keys())
+        arrays['tiles'] = np.array(tiles, dtype=np.int32).reshape(-1, 4)
+        arrays['tiles_pics'] = np.array([pics_idx[mosaic_datas[tile]] for tile in tiles], dtype=np.int64)
+    for name in ['order', 'tiles', 'tiles_pics']:
+        if name not in arrays and os.path.exists(os.path.join(store_path, name + '.npy')):
+            os.remove(os.path.join(store_path, name + '.npy'))
+    # each array is written aside and renamed, so the arrays memory-mapped by an open PaletteStore stay valid
+    for name, array in arrays.items():
+        temp_path = os.path.join(store_path, '{}.{}.tmp.npy'.format(name, os.getpid()))
+        np.save(temp_path, array)
+        os.replace(temp_path, os.path.join(store_path, name + '.npy'))
+    # meta.json is written last, its mtime is the one of the whole store
+    with open(os.path.join(store_path, 'meta.json'), 'w') as meta_file:
+        meta_file.write(json.dumps({'version': STORE_VERSION, 'count': count}))
+    print(store_path, 'saved')
+
+class PaletteStore:
+    '''
+    Read access to a palette store, arrays are memory-mapped by default
+
+    Args:
+        store_path (str) : path of the store directory
+        mmap (bool) : memory-map the arrays instead of reading them
+    '''
+    def __init__(self, store_path, mmap=True):
+        self.store_path = store_path
+        with open(os.path.join(store_path, 'meta.json'), 'r') as meta_file:
+            meta = json.loads(meta_file.read())
+        if meta['version'] != STORE_VERSION:
+            raise ValueError('unsupported palette store version {}'.format(meta['version']))
+        self.count = meta['count']
+        mmap_mode = 'r' if mmap else None
+        for name in ['labs', 'rgbs', 'ratios', 'orientations', 'dates', 'paths', 'paths_offsets', 'order', 'tiles', 'tiles_pics']:
+            array_path = os.path.join(store_path, name + '.npy')
+            setattr(self, name, np.load(array_path, mmap_mode=mmap_mode) if os.path.exists(array_path) else None)
+
+    def __len__(self):
+        return self.count
+
+    def path(self, idx):
+        return bytes(self.paths[self.paths_offsets[idx]:self.paths_offsets[idx + 1]]).decode('utf-8')
+
+    def pic_datas(self, idx):
+        '''
+        Datas of a picture in the format of main.gen_dataset
+        '''
+        date = self.dates[idx].decode('ascii')
+        ratio = float(self.ratios[idx])
+        return (date or None, int(self.orientations[idx]) or None, ratio if ratio == ratio else None,
+                tuple(self.rgbs[idx].tolist()), tuple(self.labs[idx].tolist()))
+
+    def all_paths(self):
+        paths = bytes(self.paths)
+        offsets = self.paths_offsets.tolist()
+        return [paths[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+
+    def all_pic_datas(self):
+        '''
+        Datas of every picture, same as pic_datas but converted column by column
+        '''
+        dates = [date.decode('ascii') or None for date in self.dates.tolist()]
+        # a nan ratio is a missing one
+        ratios = [ratio if ratio == ratio else None for ratio in self.ratios.tolist()]
+        return [(date, orientation or None, ratio, tuple(rgb), tuple(lab)) for date, orientation, ratio, rgb, lab
+                in zip(dates, self.orientations.tolist(), ratios, self.rgbs.tolist(), self.labs.tolist())]
+
+    def to_pics_dict(self):
+        return dict(zip(self.all_paths(), self.all_pic_datas()))
+
+    def sorted_pics_list(self):
+        '''
+        The stored ordering in the format of main.NN_delta, None if no ordering is stored
+        '''
+        if self.order is None:
+            return None
+        paths, pics_datas = self.all_paths(), self.all_pic_datas()
+        return [(paths[idx], pics_datas[idx]) for idx in self.order.tolist()]
+
+    def mosaic_datas(self):
+        '''
+        The stored tile -> pic_path map in the format of main.photo_mosaic_datas, None if not stored
+        '''
+        if self.tiles is None:
+            return None
+        paths = self.all_paths()
+        return {tuple(tile): paths[idx] for tile, idx in zip(self.tiles.tolist(), self.tiles_pics.tolist())}
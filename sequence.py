@@ -0,0 +1,169 @@
+'''
+Photo mosaic animations from a sequence of frames
+
+Frames are processed as a stream against one warm library (see
+batch.Library). For each frame the model is resized and its tiles averaged
+as usual, but only the tiles whose average color moved by more than
+threshold (DeltaE76 on the sRGB colors read as 0-255 values, from the color
+they were last matched with) are matched again, and only the tiles whose picture changed are pasted again
+on the mosaic of the previous frame. Each mosaic frame is written as soon
+as it is done, by a writer thread so encoding overlaps the next frame.
+
+Videos can be split into frames beforehand, e.g. ffmpeg -i clip.mp4 frames/%06d.png
+
+Usage: python sequence.py FRAMES_DIR [--output-dir DIR] [--threshold DELTA_E] [--tile-width W] [--scale S]
+'''
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+import instrumentation
+from color_diff import rgb_to_lab
+from tile_cache import TileCache
+from batch import Library
+from main import analyze_model, photo_mosaic_size
+
+FRAME_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+def list_frames(frames_path):
+    '''
+    Sorted paths of the frames of a directory
+    '''
+    return sorted(os.path.join(frames_path, file_name) for file_name in os.listdir(frames_path)
+                  if os.path.splitext(file_name)[1].lower() in FRAME_EXTENSIONS)
+
+class SequenceMosaic:
+    '''
+    Incremental photo mosaic of consecutive frames
+
+    Args:
+        library (batch.Library) : warm palette, index, color lookup table and tile cache
+        tile_width (int), tile_height (int), pic_maxsize (tuple), scale (int) : see main.gen_photo_mosaic
+        threshold (float) : DeltaE76 a tile color has to move to be matched again, 0 to match every tile.
+            Measured on the Lab colors of rgb_to_lab(rgbs, is_upscaled=True), where one level more on one
+            channel of the average RGB is less than 1, the palette Lab colors are only used for matching
+    '''
+    def __init__(self, library, tile_width, tile_height, pic_maxsize, scale=1, threshold=2.0):
+        self.library = library
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.pic_maxsize = pic_maxsize
+        self.scale = scale
+        self.threshold = threshold
+        self.tile_size = (tile_width*scale, tile_height*scale)
+        self.mosaic = Image.new('RGB', photo_mosaic_size(tile_width, tile_height, pic_maxsize, scale))
+        self.tiles = None
+
+    def match(self, rgbs, labs):
+        if self.library.lut is not None:
+            return self.library.lut.closest_batch(rgbs)
+        return self.library.index.closest_batch(labs)
+
+    def process(self, frame_path):
+        '''
+        Update the mosaic with the next frame
+
+        Args:
+            frame_path (str) : path of the frame
+
+        Returns:
+            frame_stats (dict) : tiles, rematched and repainted tiles of the frame
+        '''
+        resized_model, tiles_dict = analyze_model(frame_path, self.tile_width, self.tile_height, self.pic_maxsize)
+        tiles = list(tiles_dict.keys())
+        rgbs = np.array([tiles_dict[tile] for tile in tiles], dtype=np.int64).reshape(-1, 3)
+        labs = rgb_to_lab(rgbs)
+        # the palette colors (and labs) come from 0-255 values read as 0-1 ones, far from perceptual
+        colors = rgb_to_lab(rgbs, is_upscaled=True)
+        if tiles != self.tiles:
+            # first frame or new frame size: everything is matched and painted on a blank mosaic,
+            # the tiles of the previous frames outside the new grid must not stay
+            self.tiles = tiles
+            self.mosaic = Image.new('RGB', self.mosaic.size)
+            self.matched_colors = colors.copy()
+            self.paths = [None]*len(tiles)
+            changed = np.arange(len(tiles))
+        else:
+            moves = np.sqrt(((colors - self.matched_colors)**2).sum(axis=1))
+            changed = np.flatnonzero(moves > self.threshold) if self.threshold > 0 else np.arange(len(tiles))
+        repainted = 0
+        with instrumentation.stage('matching', len(changed)):
+            new_paths = self.match(rgbs[changed], labs[changed]) if len(changed) else []
+        with instrumentation.stage('render') as render:
+            for tile_idx, path in zip(changed.tolist(), new_paths):
+                self.matched_colors[tile_idx] = colors[tile_idx]
+                if path != self.paths[tile_idx]:
+                    self.paths[tile_idx] = path
+                    new_box = tuple(coord*self.scale for coord in tiles[tile_idx])
+                    self.mosaic.paste(self.library.tile_cache.get(path, self.tile_size), new_box)
+                    repainted += 1
+            render.items = repainted
+        return {'tiles': len(tiles), 'rematched': len(changed), 'repainted': repainted}
+
+def gen_sequence_mosaic(frames, library, output_dir, tile_width, tile_height, pic_maxsize, scale=1,
+                        threshold=2.0, output_format='png'):
+    '''
+    Generate the photo mosaic of every frame of a sequence
+
+    Args:
+        frames (iterable) : paths of the frames, in order
+        library (batch.Library) : warm palette, index, color lookup table and tile cache
+        output_dir (str) : directory of the mosaic frames, written as frame_000000.<output_format>...
+        tile_width, tile_height, pic_maxsize, scale : see main.gen_photo_mosaic
+        threshold (float) : see SequenceMosaic
+        output_format (str) : png, ppm or jpg
+
+    Returns:
+        summary (dict) : frames, fps, and the totals of the frame_stats of SequenceMosaic.process
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    sequence = SequenceMosaic(library, tile_width, tile_height, pic_maxsize, scale, threshold)
+    save_options = {'compress_level': 1} if output_format == 'png' else {}
+    totals = {'frames': 0, 'tiles': 0, 'rematched': 0, 'repainted': 0}
+    start_time = time.perf_counter()
+    pending_write = None
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for frame_idx, frame_path in enumerate(frames):
+            frame_stats = sequence.process(frame_path)
+            for name, value in frame_stats.items():
+                totals[name] += value
+            totals['frames'] += 1
+            # at most one frame being written while the next one is composed
+            if pending_write is not None:
+                pending_write.result()
+            output_path = os.path.join(output_dir, 'frame_{:06d}.{}'.format(frame_idx, output_format))
+            pending_write = writer.submit(sequence.mosaic.copy().save, output_path, **save_options)
+            elapsed = time.perf_counter() - start_time
+            print('[{}] {} : {} tiles matched again, {} repainted ({:.2f} fps)'.format(
+                frame_idx, frame_path, frame_stats['rematched'], frame_stats['repainted'], totals['frames']/elapsed))
+        if pending_write is not None:
+            pending_write.result()
+    elapsed = time.perf_counter() - start_time
+    totals['seconds'] = elapsed
+    totals['fps'] = totals['frames']/elapsed if elapsed > 0 else None
+    totals['rematched_ratio'] = totals['rematched']/totals['tiles'] if totals['tiles'] else 0.0
+    totals['tile_cache'] = library.tile_cache.stats()
+    print('{frames} frames in {seconds:.2f}s, {fps:.2f} fps, {rematched_ratio:.1%} of the tiles matched again'.format(**totals))
+    return totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the photo mosaics of a sequence of frames')
+    parser.add_argument('frames', help='directory of the frames, processed in file name order')
+    parser.add_argument('--output-dir', default='sequence_output', help='directory of the mosaic frames')
+    parser.add_argument('--dataset', default='dataset', help='root directory of the pictures')
+    parser.add_argument('--threshold', type=float, default=2.0, help='DeltaE76 a tile color has to move to be matched again')
+    parser.add_argument('--tile-width', type=int, default=12)
+    parser.add_argument('--tile-ratio', type=float, default=4/3)
+    parser.add_argument('--max-size', type=int, default=1024, help='maximal width and height of the resized frames')
+    parser.add_argument('--scale', type=int, default=2)
+    parser.add_argument('--format', default='png', choices=('png', 'ppm', 'jpg'))
+    args = parser.parse_args()
+
+    sequence_library = Library(args.dataset, tile_cache=TileCache(cache_dir='tile_cache'))
+    gen_sequence_mosaic(list_frames(args.frames), sequence_library, args.output_dir, args.tile_width,
+                        int(args.tile_width/args.tile_ratio), (args.max_size, args.max_size), args.scale,
+                        args.threshold, args.format)
+    sequence_library.save_lut()
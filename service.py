@@ -0,0 +1,244 @@
+'''
+Local photo mosaic HTTP service with a warm library
+
+The analyzed library, its nearest color index and the tile cache are loaded
+once (see batch.Library) and stay in memory, so a request only pays for the
+model analysis, the matching and the rendering.
+
+    POST /mosaic?tile_width=12&tile_ratio=1.333&scale=2&max_width=512&max_height=512&format=png
+        body : the model image (any format PIL can open)
+        optional : tile_height (instead of tile_ratio), max_uses, min_distance
+        format=png returns the photo mosaic, format=json the tile -> picture map
+    GET /stats : library size, requests, rejections and tile cache statistics
+    GET /health
+
+Requests run in threads. At most max_concurrent of them are processed at the
+same time and at most max_queued wait for a slot, the others are rejected
+right away with 503 so a burst can't pile up unbounded work.
+
+Usage: python service.py [--host HOST] [--port PORT] [--dataset DIR] [--max-concurrent N] [--max-queued N]
+'''
+import io
+import json
+import time
+import argparse
+import threading
+import traceback
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+from tile_cache import TileCache
+from batch import Library
+from main import analyze_model, photo_mosaic_datas, compose_photo_mosaic, photo_mosaic_size
+
+MAX_BODY_BYTES = 32*1024*1024
+MAX_MOSAIC_PIXELS = 64*1024*1024
+
+class AdmissionControl:
+    '''
+    Bound the number of requests processed and waiting at the same time
+
+    Args:
+        max_concurrent (int) : number of requests processed at the same time
+        max_queued (int) : number of requests waiting for a slot, more are rejected
+    '''
+    def __init__(self, max_concurrent, max_queued):
+        self.slots = threading.Semaphore(max_concurrent)
+        self.max_admitted = max_concurrent + max_queued
+        self.admitted = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        '''
+        Wait for a processing slot
+
+        Returns:
+            admitted (bool) : False if too many requests are already waiting
+        '''
+        with self.lock:
+            if self.admitted >= self.max_admitted:
+                self.rejected += 1
+                return False
+            self.admitted += 1
+            self.accepted += 1
+        self.slots.acquire()
+        return True
+
+    def leave(self):
+        self.slots.release()
+        with self.lock:
+            self.admitted -= 1
+
+def mosaic_settings(query):
+    '''
+    Read the tile parameters of a /mosaic request
+
+    Args:
+        query (dict) : parsed query string, see urllib.parse.parse_qs
+
+    Returns:
+        settings (dict) : tile_width, tile_height, pic_maxsize, scale, max_uses, min_distance and format
+    '''
+    def value(name, cast, default=None):
+        return cast(query[name][0]) if name in query else default
+    tile_width = value('tile_width', int, 12)
+    tile_ratio = value('tile_ratio', float, 4/3)
+    if not tile_ratio > 0:
+        raise ValueError('tile_ratio must be positive')
+    tile_height = value('tile_height', int) or int(tile_width/tile_ratio)
+    settings = {
+        'tile_width': tile_width,
+        'tile_height': tile_height,
+        'pic_maxsize': (value('max_width', int, 512), value('max_height', int, 512)),
+        'scale': value('scale', int, 1),
+        'max_uses': value('max_uses', int),
+        'min_distance': value('min_distance', float),
+        'format': value('format', str, 'png'),
+    }
+    if min(tile_width, tile_height, settings['scale'], *settings['pic_maxsize']) < 1:
+        raise ValueError('tile sizes, scale and maximal sizes must be positive')
+    if settings['format'] not in ('png', 'json'):
+        raise ValueError('format must be png or json')
+    # the height of the mosaic follows the tile ratio, not max_height
+    mosaic_width, mosaic_height = photo_mosaic_size(tile_width, tile_height, settings['pic_maxsize'], settings['scale'])
+    if mosaic_width*mosaic_height > MAX_MOSAIC_PIXELS:
+        raise ValueError('the photo mosaic would be larger than {} pixels'.format(MAX_MOSAIC_PIXELS))
+    return settings
+
+class MosaicServer(ThreadingMixIn, HTTPServer):
+    '''
+    Args:
+        address (tuple) : (host, port) to listen on
+        library (batch.Library) : warm palette, index and tile cache
+        max_concurrent (int), max_queued (int) : see AdmissionControl
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, library, max_concurrent=4, max_queued=16):
+        HTTPServer.__init__(self, address, MosaicRequestHandler)
+        self.library = library
+        self.admission = AdmissionControl(max_concurrent, max_queued)
+
+    def make_mosaic(self, model_file, settings):
+        '''
+        Match and render the photo mosaic of a model image
+
+        Args:
+            model_file (file object) : the model image
+            settings (dict) : see mosaic_settings
+
+        Returns:
+            (content_type, body) of the response
+        '''
+        library = self.library
+        tile_width, tile_height, pic_maxsize = settings['tile_width'], settings['tile_height'], settings['pic_maxsize']
+        model_datas = analyze_model(model_file, tile_width, tile_height, pic_maxsize)
+        mosaic_dict = photo_mosaic_datas(None, None, tile_width, tile_height, pic_maxsize,
+                                         index=library.index, model_datas=model_datas,
+                                         max_uses=settings['max_uses'], min_distance=settings['min_distance'], lut=library.lut)
+        if settings['format'] == 'json':
+            tiles = [list(tile) + [path] for tile, path in mosaic_dict.items()]
+            return 'application/json', json.dumps({'tiles': tiles}).encode('utf-8')
+        mosaic = compose_photo_mosaic(mosaic_dict, tile_width, tile_height, pic_maxsize, settings['scale'], library.tile_cache)
+        output = io.BytesIO()
+        mosaic.save(output, format='PNG', compress_level=1)
+        return 'image/png', output.getvalue()
+
+    def stats(self):
+        return {
+            'library_pics': len(self.library.pics_dict),
+            'requests': self.admission.accepted,
+            'in_flight': self.admission.admitted,
+            'rejected': self.admission.rejected,
+            'tile_cache': self.library.tile_cache.stats(),
+            'match_lut': self.library.lut.stats() if self.library.lut is not None else None,
+        }
+
+class MosaicRequestHandler(BaseHTTPRequestHandler):
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, datas, headers=None):
+        self.send_body(status, 'application/json', json.dumps(datas).encode('utf-8'), headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif path == '/stats':
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/mosaic':
+            self.send_json(404, {'error': 'unknown path {}'.format(url.path)})
+            return
+        try:
+            body_size = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            body_size = -1
+        if body_size <= 0 or body_size > MAX_BODY_BYTES:
+            # the body is not read, the connection can't be reused
+            self.close_connection = True
+            self.send_json(413 if body_size > MAX_BODY_BYTES else 400,
+                           {'error': 'the body must be a model image of at most {} bytes'.format(MAX_BODY_BYTES)})
+            return
+        try:
+            settings = mosaic_settings(parse_qs(url.query))
+        except ValueError as error:
+            self.close_connection = True
+            self.send_json(400, {'error': str(error)})
+            return
+        # the (capped) body is read before taking a slot, so slow uploads don't hold the render slots
+        model_bytes = self.rfile.read(body_size)
+        if not self.server.admission.enter():
+            self.send_json(503, {'error': 'too many requests'}, {'Retry-After': '1'})
+            return
+        start_time = time.perf_counter()
+        # the slot is released before answering, so the client can send its next request right away
+        try:
+            content_type, body = self.server.make_mosaic(io.BytesIO(model_bytes), settings)
+            status, error = 200, None
+        except (OSError, ValueError, Image.DecompressionBombError) as request_error:
+            status, error = 400, request_error
+        except Exception as server_error:
+            self.log_error('%s', traceback.format_exc())
+            status, error = 500, server_error
+        finally:
+            self.server.admission.leave()
+        if error is not None:
+            self.send_json(status, {'error': '{}: {}'.format(type(error).__name__, error)})
+            return
+        self.send_body(200, content_type, body, {'X-Mosaic-Seconds': '{:.3f}'.format(time.perf_counter() - start_time)})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve photo mosaics from a warm library')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--dataset', default='dataset', help='root directory of the pictures')
+    parser.add_argument('--tile-cache-dir', default='tile_cache', help='directory of the on-disk thumbnails')
+    parser.add_argument('--max-concurrent', type=int, default=4, help='requests processed at the same time')
+    parser.add_argument('--max-queued', type=int, default=16, help='requests waiting before rejecting new ones')
+    args = parser.parse_args()
+
+    mosaic_library = Library(args.dataset, tile_cache=TileCache(cache_dir=args.tile_cache_dir))
+    server = MosaicServer((args.host, args.port), mosaic_library, args.max_concurrent, args.max_queued)
+    print('serving {} pictures on http://{}:{}'.format(len(mosaic_library.pics_dict), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        mosaic_library.save_lut()
@@ -0,0 +1,187 @@
+'''
+Incremental writing and region reading of images too big to hold in memory
+
+The writers receive the image as horizontal bands (PIL images of the full
+width) from top to bottom and write them right away, so only one band is
+in memory at a time:
+    .ppm / .pnm : binary PPM, raw RGB rows after a short header
+    .png : RGB PNG, rows deflated in a stream and written as IDAT chunks
+read_region reads a rectangle back from these files without decoding the
+rest of the image (PPM is memory-mapped, PNG is inflated up to the last row
+of the region).
+'''
+import os
+import zlib
+import struct
+import numpy as np
+from PIL import Image
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+class PPMStripWriter:
+    '''
+    Args:
+        file_path (str) : path of the output file
+        size (tuple) : (width, height) of the whole image
+    '''
+    def __init__(self, file_path, size):
+        self.file_path = file_path
+        self.width, self.height = size
+        self.rows_written = 0
+        self.output = open(file_path, 'wb')
+        self.output.write('P6\n{} {}\n255\n'.format(self.width, self.height).encode('ascii'))
+
+    def write(self, band):
+        '''
+        Write the next band of the image
+
+        Args:
+            band (PIL.Image.Image object) : RGB band with the width of the image
+        '''
+        if band.width != self.width or self.rows_written + band.height > self.height:
+            raise ValueError('band of size {} does not fit in the image'.format(band.size))
+        self.output.write(band.tobytes())
+        self.rows_written += band.height
+
+    def close(self):
+        self.output.close()
+        if self.rows_written != self.height:
+            raise ValueError('{} rows written out of {}'.format(self.rows_written, self.height))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.output.close()
+
+class PNGStripWriter(PPMStripWriter):
+    '''
+    Args:
+        file_path (str) : path of the output file
+        size (tuple) : (width, height) of the whole image
+        compress_level (int) : zlib compression level
+        chunk_size (int) : size of the IDAT chunks
+    '''
+    def __init__(self, file_path, size, compress_level=6, chunk_size=1 << 20):
+        self.file_path = file_path
+        self.width, self.height = size
+        self.rows_written = 0
+        self.chunk_size = chunk_size
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending = b''
+        self.output = open(file_path, 'wb')
+        self.output.write(PNG_SIGNATURE)
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, datas):
+        self.output.write(struct.pack('>I', len(datas)))
+        self.output.write(chunk_type)
+        self.output.write(datas)
+        self.output.write(struct.pack('>I', zlib.crc32(chunk_type + datas) & 0xffffffff))
+
+    def write(self, band):
+        if band.width != self.width or self.rows_written + band.height > self.height:
+            raise ValueError('band of size {} does not fit in the image'.format(band.size))
+        rows = np.frombuffer(band.tobytes(), dtype=np.uint8).reshape(band.height, self.width*3)
+        # filter type 0 (None) in front of every row
+        filtered = np.hstack([np.zeros((band.height, 1), dtype=np.uint8), rows])
+        self.pending += self.compressor.compress(filtered.tobytes())
+        self.flush_chunks(self.chunk_size)
+        self.rows_written += band.height
+
+    def flush_chunks(self, min_size):
+        while len(self.pending) >= max(min_size, 1):
+            self.write_chunk(b'IDAT', self.pending[:self.chunk_size])
+            self.pending = self.pending[self.chunk_size:]
+
+    def close(self):
+        self.pending += self.compressor.flush()
+        self.flush_chunks(0)
+        self.write_chunk(b'IEND', b'')
+        PPMStripWriter.close(self)
+
+def open_strip_writer(file_path, size):
+    '''
+    Get the strip writer matching the extension of file_path (.ppm, .pnm or .png)
+    '''
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension in ('.ppm', '.pnm'):
+        return PPMStripWriter(file_path, size)
+    if file_extension == '.png':
+        return PNGStripWriter(file_path, size)
+    raise ValueError('streaming render only writes .ppm, .pnm or .png files, not {}'.format(file_path))
+
+def read_ppm_header(ppm_file):
+    fields = []
+    while len(fields) < 4:
+        line = ppm_file.readline()
+        if not line:
+            raise ValueError('truncated PPM header')
+        fields.extend(line.split(b'#')[0].split())
+    if fields[0] != b'P6' or fields[3] != b'255':
+        raise ValueError('only 8 bits binary PPM files (P6) are supported')
+    return int(fields[1]), int(fields[2]), ppm_file.tell()
+
+def read_png_region(file_path, box):
+    with open(file_path, 'rb') as png_file:
+        if png_file.read(8) != PNG_SIGNATURE:
+            raise ValueError('{} is not a PNG file'.format(file_path))
+        decompressor = zlib.decompressobj()
+        row_size = None
+        raw = b''
+        row = 0
+        rows = []
+        while row < box[3]:
+            length, chunk_type = struct.unpack('>I4s', png_file.read(8))
+            datas = png_file.read(length)
+            png_file.read(4)
+            if chunk_type == b'IHDR':
+                width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', datas)
+                if (depth, color_type, interlace) != (8, 2, 0):
+                    raise ValueError('only 8 bits non interlaced RGB PNG files are supported')
+                row_size = 3*width + 1
+                if box[2] > width or box[3] > height:
+                    raise ValueError('region {} outside of the image'.format(box))
+            elif chunk_type == b'IDAT':
+                # inflate a few hundred rows at a time to keep memory bounded
+                while datas and row < box[3]:
+                    raw += decompressor.decompress(datas, 256*row_size)
+                    datas = decompressor.unconsumed_tail
+                    position = 0
+                    while len(raw) - position >= row_size and row < box[3]:
+                        if raw[position] != 0:
+                            raise ValueError('only PNG files written without row filters are supported')
+                        if row >= box[1]:
+                            rows.append(raw[position + 1 + 3*box[0]:position + 1 + 3*box[2]])
+                        position += row_size
+                        row += 1
+                    raw = raw[position:]
+            elif chunk_type == b'IEND':
+                raise ValueError('region {} outside of the image'.format(box))
+    return Image.frombytes('RGB', (box[2] - box[0], box[3] - box[1]), b''.join(rows))
+
+def read_region(file_path, box):
+    '''
+    Read a rectangle of an image written by a strip writer
+
+    Args:
+        file_path (str) : path of a .ppm, .pnm or .png file
+        box (tuple) : (left, upper, right, lower) rectangle to read
+
+    Returns:
+        region (PIL.Image.Image object) : the RGB pixels of the rectangle
+    '''
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension == '.png':
+        return read_png_region(file_path, box)
+    with open(file_path, 'rb') as ppm_file:
+        width, height, offset = read_ppm_header(ppm_file)
+    if box[2] > width or box[3] > height:
+        raise ValueError('region {} outside of the image'.format(box))
+    pixels = np.memmap(file_path, dtype=np.uint8, mode='r', offset=offset, shape=(height, width, 3))
+    region = np.ascontiguousarray(pixels[box[1]:box[3], box[0]:box[2]])
+    del pixels
+    return Image.frombytes('RGB', (box[2] - box[0], box[3] - box[1]), region.tobytes())
@@ -0,0 +1,151 @@
+'''
+Cache of the resized pictures pasted as tiles by gen_photo_mosaic
+
+Level 1 is an in-memory LRU of resized tiles keyed by (path, tile size) and
+bounded by a byte budget, safe to share between threads. Level 2 is an optional directory of pre-scaled
+thumbnails (lossless PNG) which survives between runs, a thumbnail is
+invalidated when the mtime or size of its source picture changes.
+'''
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+def load_tile(pic_path, tile_size):
+    '''
+    Decode a picture and resize it to a tile
+
+    Args:
+        pic_path (str) : path of the picture
+        tile_size (tuple) : (width, height) of the tile
+
+    Returns:
+        tile_pic (PIL.Image.Image object) : the resized picture in RGB mode
+    '''
+    with Image.open(pic_path) as pic:
+        pic.draft(pic.mode, (tile_size[0]*2, tile_size[1]*2))
+        tile_pic = pic.resize(tile_size)
+    if tile_pic.mode != 'RGB':
+        tile_pic = tile_pic.convert('RGB')
+    return tile_pic
+
+def thumbnail_path(cache_dir, pic_path, tile_size):
+    stat = os.stat(pic_path)
+    key = '{}|{}|{}|{}x{}'.format(os.path.abspath(pic_path), stat.st_mtime, stat.st_size, *tile_size)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.png')
+
+def load_thumbnail(pic_path, tile_size, cache_dir):
+    '''
+    Load a tile from the on-disk thumbnails, decoding and storing it if missing
+
+    Args:
+        pic_path (str) : path of the picture
+        tile_size (tuple) : (width, height) of the tile
+        cache_dir (str) : directory of the on-disk thumbnails
+
+    Returns:
+        (tile_pic, from_disk) :
+            tile_pic (PIL.Image.Image object) : same as load_tile(pic_path, tile_size)
+            from_disk (bool) : True if the thumbnail already existed
+    '''
+    tile_path = thumbnail_path(cache_dir, pic_path, tile_size)
+    if os.path.exists(tile_path):
+        with Image.open(tile_path) as thumbnail:
+            return thumbnail.convert('RGB'), True
+    tile_pic = load_tile(pic_path, tile_size)
+    # threads of one process can store the same tile at the same time
+    temp_path = '{}.{}.{}.tmp'.format(tile_path, os.getpid(), threading.get_ident())
+    tile_pic.save(temp_path, format='PNG')
+    os.replace(temp_path, tile_path)
+    return tile_pic, False
+
+class TileCache:
+    '''
+    Args:
+        max_bytes (int) : memory budget of the in-memory LRU
+        cache_dir (str) : directory of the on-disk thumbnails, no disk level if None
+    '''
+    def __init__(self, max_bytes=256*1024*1024, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.tiles = OrderedDict()
+        self.current_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, pic_path, tile_size):
+        '''
+        Get a resized tile, decoding the picture only if it is in neither level
+
+        Args:
+            pic_path (str) : path of the picture
+            tile_size (tuple) : (width, height) of the tile
+
+        Returns:
+            tile_pic (PIL.Image.Image object) : same as load_tile(pic_path, tile_size)
+        '''
+        tile_pic = self.get_memory(pic_path, tile_size)
+        if tile_pic is not None:
+            return tile_pic
+        if self.cache_dir is not None:
+            tile_pic, from_disk = load_thumbnail(pic_path, tile_size, self.cache_dir)
+        else:
+            tile_pic, from_disk = load_tile(pic_path, tile_size), False
+        self.add(pic_path, tile_size, tile_pic, from_disk)
+        return tile_pic
+
+    def get_memory(self, pic_path, tile_size):
+        '''
+        Get a resized tile from the in-memory LRU only, None if missing
+        '''
+        key = (pic_path, tuple(tile_size))
+        with self.lock:
+            tile_pic = self.tiles.get(key)
+            if tile_pic is not None:
+                self.tiles.move_to_end(key)
+                self.memory_hits += 1
+        return tile_pic
+
+    def add(self, pic_path, tile_size, tile_pic, from_disk=False):
+        '''
+        Add a tile loaded outside of the cache (e.g. by a worker process) to the in-memory LRU
+        '''
+        with self.lock:
+            if from_disk:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            self.put((pic_path, tuple(tile_size)), tile_pic)
+
+    def put(self, key, tile_pic):
+        tile_bytes = tile_pic.width*tile_pic.height*len(tile_pic.getbands())
+        if tile_bytes > self.max_bytes:
+            return
+        if key in self.tiles:
+            replaced_pic = self.tiles.pop(key)
+            self.current_bytes -= replaced_pic.width*replaced_pic.height*len(replaced_pic.getbands())
+        self.tiles[key] = tile_pic
+        self.current_bytes += tile_bytes
+        while self.current_bytes > self.max_bytes:
+            evicted_key, evicted_pic = self.tiles.popitem(last=False)
+            self.current_bytes -= evicted_pic.width*evicted_pic.height*len(evicted_pic.getbands())
+            self.evictions += 1
+
+    def stats(self):
+        requests = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'requests': requests,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.memory_hits + self.disk_hits)/requests if requests else 0.0,
+            'memory_bytes': self.current_bytes,
+            'memory_tiles': len(self.tiles),
+        }